@@ -1,4 +1,6 @@
 import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 # 必须在导入 sentence_transformers 之前设置环境变量，否则镜像源可能不生效
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'
 # 抑制 TensorFlow 日志
@@ -18,8 +20,11 @@ from core_logic import (
     FictionDiffusionLayer,
     QwenGenerationLayer,
     ContentAuditor,
-    ExternalKnowledgeLayer
+    ContextPacker,
+    CachedPipeline
 )
+from llm_scheduler import get_llm_scheduler
+from index_store import get_index_manager
 
 # --- 0. 基础配置 ---
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -35,21 +40,108 @@ except ImportError:
 api_key = os.getenv('DASHSCOPE_API_KEY')
 if api_key:
     dashscope.api_key = api_key
-else:
+elif os.getenv('MINGYU_LLM_BACKEND') != 'stub':
     st.warning("⚠️ 未检测到 DASHSCOPE_API_KEY，请在 .env 文件中配置，否则无法使用 Qwen 生成文本。")
 
 st.set_page_config(page_title="明域 · 伪史生成系统", layout="wide", page_icon="🐉")
 
 # --- UI 逻辑 ---
 
+def compute_projection(layer1, fact_vec, query_vec, gen_vec):
+    """PCA 降维，返回绘图用的 DataFrame"""
+    # 准备绘图数据
+    # 1. 事实点
+    # 2. 用户查询点
+    # 3. 生成点 (插值点)
+    # 4. 背景点 (随机取一些)
+    
+    subset_indices = list(range(min(len(layer1.db_data), 50)))
+    subset_vecs = layer1.db_embeddings[subset_indices]
+    subset_names = [layer1.db_data[i]['name'] for i in subset_indices]
+    
+    # 降维
+    all_vecs = np.vstack([subset_vecs, fact_vec, query_vec, gen_vec])
+    pca = PCA(n_components=2)
+    all_coords = pca.fit_transform(all_vecs)
+    
+    # 背景数据
+    bg_len = len(subset_vecs)
+    df_bg = pd.DataFrame({
+        'x': all_coords[:bg_len, 0],
+        'y': all_coords[:bg_len, 1],
+        'label': subset_names,
+        'type': ['History Background'] * bg_len
+    })
+    
+    # 特殊点
+    df_special = pd.DataFrame({
+        'x': [all_coords[bg_len, 0], all_coords[bg_len+1, 0], all_coords[bg_len+2, 0]],
+        'y': [all_coords[bg_len, 1], all_coords[bg_len+1, 1], all_coords[bg_len+2, 1]],
+        'label': ['历史锚点 (Fact)', '用户假设 (Query)', '生成伪史 (Generated)'],
+        'type': ['Anchor', 'Query', 'Generated']
+    })
+    
+    return pd.concat([df_bg, df_special])
+
+def build_figure(final_df):
+    fig = px.scatter(final_df, x='x', y='y', color='type', hover_data=['label'],
+                     symbol='type', size_max=15, title="历史语义拓扑空间")
+    
+    fig.update_traces(marker=dict(size=12))
+    return fig
+
+def render_generation(generated_pseudo_history, query, layer2, auditor):
+    """生成结果面板：伪史正文 + 制度校验 + 双重审核"""
+    # 显示生成的“伪史”
+    st.markdown(generated_pseudo_history)
+    
+    # 制度校验结果
+    st.markdown("####  Layer 2: 制度-语境对齐校验")
+    # 对大模型生成的文本进行校验
+    gen_validation = layer2.validate(generated_pseudo_history)
+    
+    if gen_validation['is_valid']:
+        st.success(f" 通过校验 (Score: {gen_validation['score']:.2f})")
+        st.markdown(f"**识别到的制度关键词**：`{', '.join(gen_validation['keywords'])}`")
+    else:
+        st.warning("⚠️ 警告：未检测到典型的明代制度特征，生成内容可能偏离时代语境。")
+        
+    # 6. 双重审核 (Auditor)
+    # 审核的是大模型生成的文本，而不是检索到的文本
+    audit_result = auditor.audit(query, generated_pseudo_history)
+    st.markdown("####  Double Review: 内容合规性审核")
+    if audit_result['passed']:
+        st.success(f"✅ {audit_result['message']}")
+    else:
+        st.error(f"❌ {audit_result['message']}")
+        st.caption("建议：调整 Alpha 值或细化指令以匹配已有史料库。")
+
 def main():
     # 初始化各层
     layer1 = HistoryEmbeddingLayer(VECTOR_FILE)
     layer2 = ContextAlignmentLayer()
     layer3 = FictionDiffusionLayer(layer1)
-    layer4 = QwenGenerationLayer()
+    # 会话 ID 用于 LLM 调度器的按会话公平排队
+    if 'session_id' not in st.session_state:
+        st.session_state.session_id = uuid.uuid4().hex
+    layer4 = QwenGenerationLayer(session_id=st.session_state.session_id)
     auditor = ContentAuditor()
 
+    # 分阶段缓存：每个阶段只依赖自己的输入，拖动滑块时只重算下游阶段
+    if 'pipeline' not in st.session_state:
+        packer = ContextPacker(token_budget=int(os.getenv('MINGYU_CONTEXT_TOKENS', 400)))
+        st.session_state.pipeline = CachedPipeline(layer1, layer3, layer4, packer=packer)
+    pipeline = st.session_state.pipeline
+    # 每次 rerun 绑定新的各层，索引热更新后自动丢弃依赖旧索引的缓存；
+    # 本次运行结束 (包括 st.stop / rerun) 时解绑，空闲会话不再持有旧索引版本
+    pipeline.bind(layer1, layer3, layer4)
+    try:
+        render_page(layer1, layer2, auditor, pipeline)
+    finally:
+        pipeline.release()
+
+def render_page(layer1, layer2, auditor, pipeline):
+    """侧边栏 + 主界面；各层只在本次运行内使用"""
     # 侧边栏
     with st.sidebar:
         st.title("🐉 明域 MingYu")
@@ -60,6 +152,19 @@ def main():
         alpha = st.slider("虚构扩散系数 (Alpha)", 0.0, 1.0, 0.3, help="0=完全史实, 1=完全虚构")
         threshold = st.slider("合理性阈值 (Credibility)", 0.0, 1.0, 0.4, help="过滤掉语义距离过远的结果")
         
+        with st.expander("📈 编码服务指标 (Encoder Service)"):
+            if hasattr(layer1.model, 'metrics'):
+                st.json(layer1.model.metrics())
+
+        with st.expander("🚦 LLM 调度器 (LLM Scheduler)"):
+            st.json(get_llm_scheduler().metrics())
+
+        with st.expander("📚 索引版本 (Index Version)"):
+            st.json(get_index_manager(VECTOR_FILE).status())
+
+        with st.expander("🗂 阶段缓存 (Stage Cache)"):
+            st.json(pipeline.stats())
+
         st.info("💡 **操作指南**：\n输入一个“假如”的历史情境，系统将在明代语义流形中寻找最合理的“伪史”落点。")
 
     # 主界面
@@ -71,49 +176,39 @@ def main():
     query = st.text_input("📝 输入历史假设 / 探索节点", "假如张居正支持万历皇帝彻底清算冯保")
     
     if st.button("启动生成引擎", type="primary"):
+        st.session_state.active_query = query
+
+    # 按钮只在点击的那次 rerun 中为 True，记住已提交的假设，之后调整滑块时复用上游阶段的缓存
+    active_query = st.session_state.get('active_query')
+    if active_query:
+        query = active_query
         if not layer1.db_data:
             st.error("数据未加载，请检查 build_index.py 是否运行。")
             st.stop()
             
-        with st.spinner("正在遍历历史语义流形并生成伪史..."):
-            # 1. 编码用户输入 (Layer 1)
-            query_vec = layer1.encode(query)
+        with st.spinner("正在遍历历史语义流形..."):
+            # 1. 编码用户输入 (Layer 1) —— 仅依赖 query
+            query_vec = pipeline.query_embedding(query)
             
-            # 2. 检索最近的历史事实 (Layer 1)
+            # 2. 检索最近的历史事实 (Layer 1) —— 仅依赖 query
             # 这是“锚点”，确保虚构不脱离历史基底
-            fact_results = layer1.search(query_vec, top_k=1)
-            fact_item = fact_results[0]
+            fact_item = pipeline.anchor(query)
             fact_vec = fact_item['vector']
             
-            # 3. 向量插值与扩散 (Layer 3)
-            # 传入 exclude_id，确保不返回史实本身
-            gen_vec, nearby_results = layer3.interpolate_and_generate(
-                fact_vec, 
-                query_vec, 
-                alpha, 
-                exclude_id=fact_item['data']['id']
-            )
+            # 3. 向量插值与扩散 (Layer 3) —— 依赖 query + alpha
+            # 排除史实本身；邻域检索沿预计算的 kNN 图进行
+            gen_vec, nearby_results = pipeline.diffusion(query, alpha)
             
             # 4. 制度校验 (Layer 2)
             # 对生成结果（这里用最近邻近似）进行校验
             best_match = nearby_results[0] # 最接近插值点的文本
             validation = layer2.validate(best_match['data']['text'])
             
-            # 5. 大模型生成 (Layer 4 - NEW)
-            # 提取 context 文本列表
-            nearby_texts = [r['data']['text'] for r in nearby_results]
-            generated_pseudo_history = layer4.generate(
-                query, 
-                fact_item['data']['text'], 
-                nearby_texts, 
-                alpha
-            )
-            
-            # 6. 双重审核 (Auditor)
-            # 审核的是大模型生成的文本，而不是检索到的文本
-            audit_result = auditor.audit(query, generated_pseudo_history)
+            # 在 token 预算内压缩锚点与邻域文本：去掉跨片段重复的句子，按与 query 的相似度取舍
+            packed_fact, packed_context, pack_report = pipeline.packing(query, alpha)
             
         # --- 结果展示 ---
+        # 先把各面板的位置占好，后面哪个阶段先完成就先填哪个
         
         col1, col2 = st.columns([1, 1])
         
@@ -125,72 +220,15 @@ def main():
             st.divider()
             
             st.subheader(" 生成的合理伪史 (Qwen Generated Pseudo-History)")
-            st.caption(f"基于插值向量 (Alpha={alpha}) + Qwen-Plus 生成")
-            
-            # 显示生成的“伪史”
-            st.markdown(generated_pseudo_history)
-            
-            # 制度校验结果
-            st.markdown("####  Layer 2: 制度-语境对齐校验")
-            # 对大模型生成的文本进行校验
-            gen_validation = layer2.validate(generated_pseudo_history)
-            
-            if gen_validation['is_valid']:
-                st.success(f" 通过校验 (Score: {gen_validation['score']:.2f})")
-                st.markdown(f"**识别到的制度关键词**：`{', '.join(gen_validation['keywords'])}`")
-            else:
-                st.warning("⚠️ 警告：未检测到典型的明代制度特征，生成内容可能偏离时代语境。")
-                
-            # 双重审核结果
-            st.markdown("####  Double Review: 内容合规性审核")
-            if audit_result['passed']:
-                st.success(f"✅ {audit_result['message']}")
-            else:
-                st.error(f"❌ {audit_result['message']}")
-                st.caption("建议：调整 Alpha 值或细化指令以匹配已有史料库。")
+            st.caption(f"基于插值向量 (Alpha={alpha}) + Qwen-Plus 生成 · "
+                       f"Prompt tokens: {pack_report['tokens_before']} → {pack_report['tokens_after']}")
+            generation_slot = st.empty()
+            generation_slot.info("⏳ 正在调用 Qwen 生成伪史...")
                 
         with col2:
             st.subheader(" 语义流形可视化")
-            
-            # 准备绘图数据
-            # 1. 事实点
-            # 2. 用户查询点
-            # 3. 生成点 (插值点)
-            # 4. 背景点 (随机取一些)
-            
-            subset_indices = list(range(min(len(layer1.db_data), 50)))
-            subset_vecs = layer1.db_embeddings[subset_indices]
-            subset_names = [layer1.db_data[i]['name'] for i in subset_indices]
-            
-            # 降维
-            all_vecs = np.vstack([subset_vecs, fact_vec, query_vec, gen_vec])
-            pca = PCA(n_components=2)
-            all_coords = pca.fit_transform(all_vecs)
-            
-            # 背景数据
-            bg_len = len(subset_vecs)
-            df_bg = pd.DataFrame({
-                'x': all_coords[:bg_len, 0],
-                'y': all_coords[:bg_len, 1],
-                'label': subset_names,
-                'type': ['History Background'] * bg_len
-            })
-            
-            # 特殊点
-            df_special = pd.DataFrame({
-                'x': [all_coords[bg_len, 0], all_coords[bg_len+1, 0], all_coords[bg_len+2, 0]],
-                'y': [all_coords[bg_len, 1], all_coords[bg_len+1, 1], all_coords[bg_len+2, 1]],
-                'label': ['历史锚点 (Fact)', '用户假设 (Query)', '生成伪史 (Generated)'],
-                'type': ['Anchor', 'Query', 'Generated']
-            })
-            
-            final_df = pd.concat([df_bg, df_special])
-            
-            fig = px.scatter(final_df, x='x', y='y', color='type', hover_data=['label'],
-                             symbol='type', size_max=15, title="历史语义拓扑空间")
-            
-            fig.update_traces(marker=dict(size=12))
-            st.plotly_chart(fig, use_container_width=True)
+            chart_slot = st.empty()
+            chart_slot.info("⏳ 正在计算 PCA 投影...")
             
             st.caption("""
             **图例说明**：
@@ -198,23 +236,57 @@ def main():
             - **Query**: 你的假设在语义空间中的位置。
             - **Generated**: 系统根据 Alpha 插值计算出的“伪史”落点。
             """)
+            cbdb_slot = st.empty()
             
-            # CBDB 补充信息
-            # 只有当条目被归类为“人物”时才调用 CBDB，避免用事件名去查人名数据库
-            category = best_match['data'].get('category', '人物') # 兼容旧数据，默认为人物
-            gen_name = best_match['data']['name']
-            
-            if validation['is_valid'] and gen_name != '未知' and category == '人物':
-                 st.divider()
-                 st.markdown(f"** {gen_name} 的真实履历 (CBDB)**")
-                 bio = ExternalKnowledgeLayer.get_cbdb_bio(gen_name)
-                 if bio:
-                     st.json(bio)
-                 else:
-                     st.write("无详细记录")
-            elif category != '人物':
+        # CBDB 补充信息
+        # 只有当条目被归类为“人物”时才调用 CBDB，避免用事件名去查人名数据库
+        category = best_match['data'].get('category', '人物') # 兼容旧数据，默认为人物
+        gen_name = best_match['data']['name']
+        need_cbdb = validation['is_valid'] and gen_name != '未知' and category == '人物'
+        if need_cbdb:
+            cbdb_slot.info(f"⏳ 正在查询 {gen_name} 的 CBDB 履历...")
+        elif category != '人物':
+            with cbdb_slot.container():
                 st.divider()
                 st.info(f"ℹ 当前条目类别为 **{category}**，不展示人物履历。")
+        
+        # 5. 大模型生成 / PCA 绘图 / CBDB 查询三者互不依赖，放进线程池并发执行，
+        # 总耗时约等于最慢的一项。Streamlit 的渲染调用只在主线程中进行。
+        with ThreadPoolExecutor(max_workers=3) as pool:
+            futures = {
+                # 以完整 prompt 为缓存键，prompt 不变就不重复调用 Qwen
+                pool.submit(pipeline.generation, query, packed_fact, packed_context, alpha): 'generation',
+                # PCA 同样只依赖 query + alpha
+                pool.submit(lambda: build_figure(pipeline.run(
+                    'projection', (query, alpha),
+                    lambda: compute_projection(layer1, fact_vec, query_vec, gen_vec)))): 'projection',
+            }
+            if need_cbdb:
+                # 查询失败 (含超时) 不缓存，下次运行重新查询
+                futures[pool.submit(pipeline.cbdb, gen_name)] = 'cbdb'
+            
+            for future in as_completed(futures):
+                stage = futures[future]
+                try:
+                    result = future.result()
+                except Exception as e:
+                    slot = {'generation': generation_slot, 'projection': chart_slot, 'cbdb': cbdb_slot}[stage]
+                    slot.error(f"{stage} 阶段失败: {e}")
+                    continue
+                
+                if stage == 'generation':
+                    with generation_slot.container():
+                        render_generation(result, query, layer2, auditor)
+                elif stage == 'projection':
+                    chart_slot.plotly_chart(result, use_container_width=True)
+                else:
+                    with cbdb_slot.container():
+                        st.divider()
+                        st.markdown(f"** {gen_name} 的真实履历 (CBDB)**")
+                        if result:
+                            st.json(result)
+                        else:
+                            st.write("无详细记录")
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,318 @@
+import os
+# 与 app.py 一致：必须在导入 sentence_transformers 之前设置镜像源
+os.environ.setdefault('HF_ENDPOINT', 'https://hf-mirror.com')
+os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
+
+import csv
+import glob
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import dashscope
+
+from encoders import load_encoder
+from llm_scheduler import LLMScheduler, load_llm_backend
+from index_store import IndexSnapshot, resolve_current
+from chunk_table import SearchResult
+from core_logic import (
+    ContextAlignmentLayer,
+    QwenGenerationLayer,
+    ContentAuditor,
+    ContextPacker,
+    pack_context,
+    GENERATION_ERROR_PREFIXES
+)
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+VECTOR_FILE = os.path.join(BASE_DIR, 'ming_vectors.pkl')
+
+
+def task_key(query, alpha):
+    return hashlib.sha1(f"{query}\t{alpha:.4f}".encode('utf-8')).hexdigest()[:16]
+
+
+def read_tasks(path, default_alphas):
+    """
+    读取 JSONL 或 CSV，每行需有 query (或 hypothesis) 字段，alpha 可选；
+    没有 alpha 的行会按 default_alphas 展开成多个任务
+    """
+    if path.endswith('.csv'):
+        with open(path, encoding='utf-8-sig', newline='') as f:
+            rows = list(csv.DictReader(f))
+    else:
+        with open(path, encoding='utf-8') as f:
+            rows = [json.loads(line) for line in f if line.strip()]
+
+    tasks = []
+    for row in rows:
+        query = (row.get('query') or row.get('hypothesis') or '').strip()
+        if not query:
+            continue
+        alphas = [float(row['alpha'])] if row.get('alpha') not in (None, '') else default_alphas
+        for alpha in alphas:
+            tasks.append({"key": task_key(query, alpha), "query": query, "alpha": alpha})
+    return tasks
+
+
+def is_done(record):
+    # 生成失败 (限流、队列已满、未配置 Key 等) 的记录照常写出便于排查，但不算完成，续跑时会重试
+    return record.get('status', 'ok') != 'error'
+
+
+class JsonlSink:
+    """逐批追加写入并 flush，进程中断后已写入的记录即为检查点"""
+    def __init__(self, path):
+        self.path = path
+
+    def done_keys(self):
+        if not os.path.exists(self.path):
+            return set()
+        keys = set()
+        with open(self.path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # 中断时写了一半的最后一行：忽略，该任务会被重跑
+                    continue
+                if 'key' in record and is_done(record):
+                    keys.add(record['key'])
+        return keys
+
+    def _drop_partial_tail(self):
+        """截掉中断时写了一半的最后一行，否则下一条记录会接在它后面一起损坏"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size == 0:
+                return
+            f.seek(size - 1)
+            if f.read(1) == b"\n":
+                return
+            # 从文件末尾向前按块查找最后一个换行符
+            end = size
+            while end > 0:
+                start = max(0, end - 65536)
+                f.seek(start)
+                newline = f.read(end - start).rfind(b"\n")
+                if newline >= 0:
+                    f.truncate(start + newline + 1)
+                    return
+                end = start
+            f.truncate(0)
+
+    def write(self, records):
+        self._drop_partial_tail()
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            f.flush()
+
+
+class ParquetSink:
+    """每个批次写一个 part 文件 (写临时文件后原子改名)，目录中已有的 part 即为检查点"""
+    def __init__(self, path):
+        import pyarrow  # noqa: F401  (fail fast if the optional dependency is missing)
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _parts(self):
+        return sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+
+    def done_keys(self):
+        import pyarrow.parquet as pq
+        keys = set()
+        for part in self._parts():
+            table = pq.read_table(part).to_pydict()
+            statuses = table.get('status', ['ok'] * len(table['key']))
+            keys.update(key for key, status in zip(table['key'], statuses) if status != 'error')
+        return keys
+
+    def write(self, records):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if not records:
+            return
+        part = os.path.join(self.path, f"part-{len(self._parts()):05d}.parquet")
+        tmp = part + ".tmp"
+        pq.write_table(pa.Table.from_pylist(records), tmp)
+        os.replace(tmp, part)
+
+
+class StageTimer:
+    """累计每个阶段的耗时与处理条数，用于输出吞吐量"""
+    def __init__(self):
+        self.seconds = {}
+        self.items = {}
+
+    def add(self, stage, seconds, items):
+        self.seconds[stage] = self.seconds.get(stage, 0.0) + seconds
+        self.items[stage] = self.items.get(stage, 0) + items
+
+    def report(self):
+        return {stage: {"items": self.items[stage],
+                        "seconds": round(self.seconds[stage], 3),
+                        "items_per_s": round(self.items[stage] / self.seconds[stage], 2) if self.seconds[stage] else None}
+                for stage in self.seconds}
+
+
+class BatchRunner:
+    """
+    Offline Batch Pipeline
+    Function: Runs many (hypothesis, alpha) tasks through the same steps as app.py: batched encoding,
+    matrix-form anchor / neighbour search, context packing, concurrent Qwen generation through the
+    LLMScheduler, then validator and auditor scores for the whole batch.
+    Neighbour search is the exact flat search (the reference the app's kNN-graph walk approximates).
+    """
+    def __init__(self, snapshot, encoder, scheduler, packer=None, max_in_flight=4):
+        self.snapshot = snapshot
+        self.encoder = encoder
+        self.generator = QwenGenerationLayer(scheduler=scheduler, session_id="batch")
+        self.packer = packer
+        self.validator = ContextAlignmentLayer()
+        self.auditor = ContentAuditor()
+        self.max_in_flight = max_in_flight
+        self.timer = StageTimer()
+
+    def _result(self, idx, score):
+        return SearchResult(self.snapshot.data, self.snapshot.embeddings, idx, score)
+
+    def search(self, query_vecs, alphas, top_k=10):
+        """Vectorized anchor + interpolation + neighbour search for a batch of query vectors"""
+        emb = self.snapshot.embeddings
+        anchor_scores = emb @ query_vecs.T
+        anchors = np.argmax(anchor_scores, axis=0)
+
+        alphas = np.asarray(alphas, dtype=np.float32)[:, None]
+        gen_vecs = (1 - alphas) * emb[anchors] + alphas * query_vecs
+        norms = np.linalg.norm(gen_vecs, axis=1, keepdims=True)
+        gen_vecs = gen_vecs / np.where(norms > 0, norms, 1.0)
+
+        gen_scores = emb @ gen_vecs.T
+        top_k = min(top_k, len(emb))
+        top = np.argpartition(-gen_scores, top_k - 1, axis=0)[:top_k]
+
+        results = []
+        for col, anchor in enumerate(anchors):
+            order = top[np.argsort(-gen_scores[top[:, col], col]), col]
+            anchor_id = self.snapshot.data[anchor].id
+            nearby = [self._result(i, gen_scores[i, col]) for i in order if self.snapshot.data[i].id != anchor_id]
+            results.append((self._result(anchor, anchor_scores[anchor, col]), nearby))
+        return results
+
+    def run_batch(self, tasks):
+        start = time.perf_counter()
+        queries = sorted({t['query'] for t in tasks})
+        vec_of = dict(zip(queries, self.encoder.encode(queries)))
+        query_vecs = np.vstack([vec_of[t['query']] for t in tasks])
+        self.timer.add('encode', time.perf_counter() - start, len(queries))
+
+        start = time.perf_counter()
+        retrieved = self.search(query_vecs, [t['alpha'] for t in tasks])
+        self.timer.add('search', time.perf_counter() - start, len(tasks))
+
+        start = time.perf_counter()
+        prompts, records = [], []
+        for task, query_vec, (fact_item, nearby) in zip(tasks, query_vecs, retrieved):
+            fact_text, context_texts, report = pack_context(
+                self.packer, self.generator, task['query'], query_vec, fact_item, nearby, task['alpha'])
+            prompts.append(self.generator.build_prompt(task['query'], fact_text, context_texts, task['alpha']))
+            records.append({
+                "key": task['key'],
+                "query": task['query'],
+                "alpha": task['alpha'],
+                "anchor_id": fact_item['data']['id'],
+                "anchor_name": fact_item['data']['name'],
+                "anchor_score": float(fact_item['score']),
+                "nearby_ids": [r['data']['id'] for r in nearby],
+                "prompt_tokens_before": report['tokens_before'],
+                "prompt_tokens_after": report['tokens_after'],
+            })
+        self.timer.add('packing', time.perf_counter() - start, len(tasks))
+
+        # 并发派发生成请求；实际并发数由 LLMScheduler 的 max_in_flight 控制
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.max_in_flight) as pool:
+            generated = list(pool.map(self.generator.generate_from_prompt, prompts))
+        self.timer.add('generation', time.perf_counter() - start, len(tasks))
+
+        # 批量计算制度校验与双重审核得分
+        start = time.perf_counter()
+        validations = [self.validator.validate(text) for text in generated]
+        audits = [self.auditor.audit(task['query'], text) for task, text in zip(tasks, generated)]
+        for record, text, validation, audit in zip(records, generated, validations, audits):
+            record.update({
+                "status": "error" if text.startswith(GENERATION_ERROR_PREFIXES) else "ok",
+                "generated": text,
+                "validation_score": validation['score'],
+                "validation_keywords": validation['keywords'],
+                "audit_passed": audit['passed'],
+                "audit_message": audit['message'],
+            })
+        self.timer.add('scoring', time.perf_counter() - start, len(tasks))
+        return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description="批量运行“假如……”假设 (支持断点续跑)")
+    parser.add_argument('input', help="输入文件 (.jsonl 或 .csv)，字段: query/hypothesis, 可选 alpha")
+    parser.add_argument('output', help="输出: .jsonl 文件，或 Parquet 目录 (--format parquet)")
+    parser.add_argument('--format', choices=['jsonl', 'parquet'], default=None, help="默认按输出扩展名推断")
+    parser.add_argument('--alphas', default="0.3", help="输入行没有 alpha 时使用的取值，逗号分隔")
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--max-in-flight', type=int, default=4, help="同时进行的 Qwen 调用数")
+    parser.add_argument('--encoder', default=None, help="编码后端，见 encoders.py")
+    parser.add_argument('--llm-backend', default=None, help="dashscope 或 stub")
+    parser.add_argument('--context-tokens', type=int, default=int(os.getenv('MINGYU_CONTEXT_TOKENS', 400)))
+    parser.add_argument('--vector-file', default=VECTOR_FILE)
+    args = parser.parse_args()
+
+    output_format = args.format or ('jsonl' if args.output.endswith('.jsonl') else 'parquet')
+    sink = JsonlSink(args.output) if output_format == 'jsonl' else ParquetSink(args.output)
+
+    tasks = read_tasks(args.input, [float(a) for a in args.alphas.split(',')])
+    done = sink.done_keys()
+    pending = [t for t in tasks if t['key'] not in done]
+    print(f"📋 共 {len(tasks)} 个任务，已完成 {len(tasks) - len(pending)}，待运行 {len(pending)}")
+    if not pending:
+        return
+
+    path = resolve_current(args.vector_file)
+    if path is None:
+        raise SystemExit(f"❌ Cannot find {args.vector_file}! Please run build_index.py first.")
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+    if os.getenv('DASHSCOPE_API_KEY'):
+        dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
+
+    scheduler = LLMScheduler(load_llm_backend(args.llm_backend),
+                             max_in_flight=args.max_in_flight, max_queue=max(args.batch_size, args.max_in_flight))
+    runner = BatchRunner(IndexSnapshot.load(path), load_encoder(args.encoder), scheduler,
+                         packer=ContextPacker(token_budget=args.context_tokens), max_in_flight=args.max_in_flight)
+
+    started = time.perf_counter()
+    for start in range(0, len(pending), args.batch_size):
+        batch = pending[start:start + args.batch_size]
+        records = runner.run_batch(batch)
+        sink.write(records)
+        failed = sum(not is_done(r) for r in records)
+        print(f"✅ {start + len(batch)}/{len(pending)}  ({time.perf_counter() - started:.1f}s)"
+              + (f"  ⚠️ {failed} 条生成失败，下次运行时重试" if failed else ""))
+    scheduler.close()
+
+    print("📊 各阶段吞吐 (items/s):")
+    for stage, row in runner.timer.report().items():
+        print(f"   {stage:<10} {row['items']:>6} 条  {row['seconds']:>8.2f}s  {row['items_per_s']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -3,10 +3,13 @@ import os
 os.environ['HF_ENDPOINT'] = 'https://hf-mirror.com'#！！！！关梯子运行更快！！！
 os.environ['TF_ENABLE_ONEDNN_OPTS'] = '0'
 import glob
-import pickle
 import numpy as np
 import re
-from sentence_transformers import SentenceTransformer
+from encoders import load_encoder
+from index_store import publish_index
+from hierarchical_index import build_hierarchy, benchmark_hierarchy
+from reduced_index import fit_projection, project_corpus, benchmark_reduced
+from chunk_table import ChunkTable
 
 # --- 核心修改开始 ---
 # 1. 获取当前脚本(build_index.py)所在的绝对路径
@@ -38,6 +41,42 @@ def clean_text(text):
     text = re.sub(r'\s+', ' ', text).strip()
     return text
 
+# 《明史》的篇目标题：以 纪/传/志/表 结尾，可带卷次，如 "太祖本纪(一)"、"鲁王朱檀、朱以海传"
+CHAPTER_HEADING = re.compile(r'^[\u4e00-\u9fff、]{1,18}(纪|传|志|表)(\([一二三四五六七八九十]+\))?$')
+# 同一篇的后续卷次单独成行，如 "(二)"
+CHAPTER_CONTINUATION = re.compile(r'^\([一二三四五六七八九十]+\)$')
+
+def is_chapter_heading(line):
+    """判断一行是否为《明史》的篇目标题或卷次行"""
+    line = line.strip()
+    return bool(CHAPTER_HEADING.match(line) or CHAPTER_CONTINUATION.match(line))
+
+def split_chapters(content, default_chapter):
+    """
+    按篇目标题把《明史》原文切成 [(章节名, 文本), ...]，标题行本身保留在正文中
+    卷次行 "(二)" 命名为 "太祖本纪(二)"；维基条目没有篇目，整篇作为一个章节
+    """
+    if '明史' not in default_chapter:
+        return [(default_chapter, content)]
+    sections = []
+    chapter, lines = default_chapter, []
+    base = default_chapter
+    for line in content.splitlines():
+        heading = line.strip()
+        if is_chapter_heading(heading):
+            if lines:
+                sections.append((chapter, "\n".join(lines)))
+            if CHAPTER_CONTINUATION.match(heading):
+                chapter = base + heading
+            else:
+                chapter = heading
+                base = re.sub(r'\([一二三四五六七八九十]+\)$', '', heading)
+            lines = []
+        lines.append(line)
+    if lines:
+        sections.append((chapter, "\n".join(lines)))
+    return sections
+
 def read_and_chunk_files(folder_path, chunk_size=150):
     """
     读取文件夹下的所有txt，并按长度切分成小段
@@ -68,28 +107,40 @@ def read_and_chunk_files(folder_path, chunk_size=150):
             with open(file_path, 'r', encoding='gbk', errors='ignore') as f:
                 content = f.read()
 
-        # 清理文本
-        content = clean_text(content)
-
         # --- 切片逻辑 (Chunking) ---
         # 简单粗暴但有效：按句号拆分，然后拼凑成 chunk_size 大小的块
-        sentences = content.replace('\n', '').split('。')
-        
+        # 块不跨章节：每个章节结束时把未满的块也存起来，保证章节质心只由本章文本构成
         current_chunk = ""
-        for sent in sentences:
-            if not sent.strip(): continue
-            
-            current_chunk += sent + "。"
-            
-            # 如果当前块够长了，就存起来，并开启新的一块
-            if len(current_chunk) >= chunk_size:
+        for chapter, section in split_chapters(content, entry_name):
+            if current_chunk:
                 all_chunks.append({
                     "id": f"{entry_name}_{len(all_chunks)}",
                     "name": entry_name,
-                    "category": category, # 新增分类字段
+                    "category": category,
+                    "chapter": chunk_chapter,
                     "text": current_chunk
                 })
-                current_chunk = "" # 重置
+                current_chunk = ""
+            chunk_chapter = chapter
+
+            # 清理文本
+            sentences = clean_text(section).split('。')
+            
+            for sent in sentences:
+                if not sent.strip(): continue
+                
+                current_chunk += sent + "。"
+                
+                # 如果当前块够长了，就存起来，并开启新的一块
+                if len(current_chunk) >= chunk_size:
+                    all_chunks.append({
+                        "id": f"{entry_name}_{len(all_chunks)}",
+                        "name": entry_name,
+                        "category": category, # 新增分类字段
+                        "chapter": chunk_chapter,
+                        "text": current_chunk
+                    })
+                    current_chunk = "" # 重置
         
         # 处理最后剩余的一点点文本
         if current_chunk:
@@ -97,12 +148,39 @@ def read_and_chunk_files(folder_path, chunk_size=150):
                 "id": f"{entry_name}_last",
                 "name": entry_name,
                 "category": category,
+                "chapter": chunk_chapter,
                 "text": current_chunk
             })
             
     return all_chunks
 
-def create_embeddings():
+def build_knn_graph(embeddings, k=10, block_size=1024):
+    """
+    分块计算每个片段的 k 近邻 (余弦相似度，排除自身)
+    每次只在内存中保留 block_size x N 的相似度矩阵
+    返回: (indices [N, k] int32, scores [N, k] float32)，按相似度降序
+    """
+    n = len(embeddings)
+    k = min(k, n - 1)
+    indices = np.zeros((n, k), dtype=np.int32)
+    scores = np.zeros((n, k), dtype=np.float32)
+    if k <= 0:
+        return indices, scores
+
+    for start in range(0, n, block_size):
+        end = min(start + block_size, n)
+        block = embeddings[start:end] @ embeddings.T
+        # 排除自身
+        block[np.arange(end - start), np.arange(start, end)] = -np.inf
+        top = np.argpartition(block, -k, axis=1)[:, -k:]
+        top_scores = np.take_along_axis(block, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        indices[start:end] = np.take_along_axis(top, order, axis=1)
+        scores[start:end] = np.take_along_axis(top_scores, order, axis=1)
+    return indices, scores
+
+def create_embeddings(backend=None, num_threads=None, knn_k=10, benchmark=False, reduce_dim=None, whiten=False,
+                      benchmark_queries=None):
     # 1. 读取并切分数据
     wiki_data = read_and_chunk_files(DATA_FOLDER)
     
@@ -112,22 +190,77 @@ def create_embeddings():
     print(f"✅ 数据预处理完成！共切分为 {len(wiki_data)} 个文本片段。")
     print("⏳ 正在加载 BGE 模型 (第一次运行需要下载)...")
     
-    model = SentenceTransformer('BAAI/bge-small-zh-v1.5')
+    # backend 可选 sentence-transformers / onnx / onnx-fp32 / hash，见 encoders.py
+    model = load_encoder(backend, num_threads=num_threads)
+    print(f"🔧 编码后端: {model.name}")
     
     print("🚀 正在生成向量 (这可能需要几十秒)...")
     texts = [item["text"] for item in wiki_data]
     
-    # normalize_embeddings=True 对计算余弦相似度非常重要
-    embeddings = model.encode(texts, normalize_embeddings=True)
+    # 所有后端都返回 L2 归一化后的向量，这对计算余弦相似度非常重要
+    embeddings = model.encode(texts)
     
     print(f"📊 向量生成完毕。维度: {embeddings.shape}")
 
-    # 保存到本地
-    output_file = 'ming_vectors.pkl'
-    with open(output_file, 'wb') as f:
-        pickle.dump({'data': wiki_data, 'embeddings': embeddings}, f)
+    # 基准查询：默认用加噪的语料片段；给定假设文件 (每行一条) 时用同一模型编码的真实查询
+    query_vecs = None
+    if benchmark and benchmark_queries:
+        with open(benchmark_queries, 'r', encoding='utf-8') as f:
+            hypotheses = [line.strip() for line in f if line.strip()]
+        query_vecs = model.encode(hypotheses)
+        print(f"🎯 基准查询: {len(hypotheses)} 条真实假设 ({benchmark_queries})")
+
+    # 预计算 kNN 图：锚点是语料片段本身，其邻居在两次建库之间不会变化
+    print(f"🕸 正在构建 kNN 图 (k={knn_k})...")
+    knn_indices, knn_scores = build_knn_graph(embeddings, k=knn_k)
+
+    # 层次索引：条目 (name) 与章节的质心向量，查询时先排条目、再只对前 E 个条目的片段精排
+    hierarchy = build_hierarchy(wiki_data, embeddings)
+    print(f"🗂 层次索引: {len(hierarchy['entry_names'])} 个条目, {len(hierarchy['chapter_names'])} 个章节")
+    if benchmark:
+        print("⏱ 层次检索 vs 全量检索 (recall@10):")
+        for row in benchmark_hierarchy(embeddings, hierarchy, queries=query_vecs):
+            print(f"   {row['mode']:<12} E={str(row['top_entries']):<4} C={str(row['top_chapters']):<4} "
+                  f"{row['latency_ms']:.3f} ms/query  recall={row['recall']:.3f}  候选片段={row['candidates']:.0f}")
+
+    # 降维检索向量：在本语料上拟合 PCA (可选白化)，查询先在低维空间取候选，再用原始向量精排
+    projection, reduced_embeddings = None, None
+    if reduce_dim:
+        projection = fit_projection(embeddings, dim=reduce_dim, whiten=whiten)
+        reduced_embeddings = project_corpus(projection, embeddings)
+        print(f"📉 降维检索向量: {embeddings.shape[1]} -> {reduced_embeddings.shape[1]} 维"
+              f"{' (白化)' if whiten else ''}, 保留方差 {projection['explained_variance']:.1%}")
+    if benchmark:
+        print("⏱ 降维检索 + 全维精排 vs 全量检索 (recall@10):")
+        for row in benchmark_reduced(embeddings, queries=query_vecs):
+            print(f"   {row['mode']:<8} dim={row['dim']:<4} whiten={str(row['whiten']):<5} 候选={row['candidates']:<6} "
+                  f"{row['latency_ms']:.3f} ms/query  recall={row['recall']:.3f}  保留方差={row['explained_variance']:.1%}")
+
+    # 保存为新的索引版本，并原子地切换 CURRENT 指针；运行中的 app 会在后台热加载
+    output_file = os.path.join(current_script_path, 'ming_vectors.pkl')
+    # 片段元数据按列存储 (字符串缓冲区 + 偏移量，条目/类别/章节字典编码)，避免每个片段一个 dict
+    version = publish_index({
+        'columns': ChunkTable.from_records(wiki_data).to_columns(),
+        'embeddings': embeddings,
+        'knn_indices': knn_indices,
+        'knn_scores': knn_scores,
+        'hierarchy': hierarchy,
+        'projection': projection,
+        'reduced_embeddings': reduced_embeddings
+    }, output_file)
     
-    print(f"💾 数据库已保存为: {output_file}")
+    print(f"💾 数据库已保存为版本: {version} (index_versions/)")
 
 if __name__ == "__main__":
-    create_embeddings()
+    import argparse
+    parser = argparse.ArgumentParser(description="构建明代历史向量数据库")
+    parser.add_argument('--backend', default=None, help="编码后端 (默认读取 MINGYU_ENCODER，否则 sentence-transformers)")
+    parser.add_argument('--threads', type=int, default=None, help="CPU 推理线程数 (intra-op threads)")
+    parser.add_argument('--knn-k', type=int, default=10, help="kNN 图中每个片段保存的邻居数")
+    parser.add_argument('--benchmark', action='store_true', help="对比层次检索、降维检索与全量检索的延迟和召回率")
+    parser.add_argument('--benchmark-queries', default=None, help="基准测试使用的真实假设文件 (每行一条)，默认用加噪的语料片段")
+    parser.add_argument('--reduce-dim', type=int, default=None, help="保存 PCA 降维检索向量的维度 (如 64/128/256)，默认不降维")
+    parser.add_argument('--whiten', action='store_true', help="降维时同时做白化")
+    args = parser.parse_args()
+    create_embeddings(backend=args.backend, num_threads=args.threads, knn_k=args.knn_k, benchmark=args.benchmark,
+                      reduce_dim=args.reduce_dim, whiten=args.whiten, benchmark_queries=args.benchmark_queries)
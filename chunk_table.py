@@ -0,0 +1,168 @@
+import numpy as np
+
+
+class _StringColumn:
+    """
+    Arrow-style string column: one concatenated UTF-16-LE byte buffer plus byte offsets
+    (row i is buffer[offsets[i]:offsets[i+1]]). Bytes rather than one big str, because a single
+    non-BMP character would make CPython store the whole joined str at 4 bytes per character.
+    """
+    __slots__ = ('buffer', 'offsets')
+    ENCODING = 'utf-16-le'
+
+    def __init__(self, buffer, offsets):
+        self.buffer = buffer
+        self.offsets = offsets
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [s.encode(cls.ENCODING) for s in strings]
+        lengths = np.fromiter((len(b) for b in encoded), dtype=np.int64, count=len(encoded))
+        return cls(b"".join(encoded), np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64))
+
+    def __getitem__(self, i):
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].decode(self.ENCODING)
+
+
+class _DictColumn:
+    """Interned (dictionary-encoded) string column: a small list of distinct values plus integer codes"""
+    __slots__ = ('values', 'codes')
+
+    def __init__(self, values, codes):
+        self.values = values
+        self.codes = codes
+
+    @classmethod
+    def from_strings(cls, strings):
+        lookup = {}
+        codes = [lookup.setdefault(s, len(lookup)) for s in strings]
+        dtype = np.uint8 if len(lookup) < 256 else np.int32
+        return cls(list(lookup), np.asarray(codes, dtype=dtype))
+
+    def __getitem__(self, i):
+        return self.values[self.codes[i]]
+
+
+class ChunkTable:
+    """
+    Columnar Chunk Metadata
+    Function: Stores id / name / category / chapter / text for every chunk without a dict per row.
+    Names, categories and chapters are dictionary-encoded; ids and texts live in single string buffers.
+    Indexing returns a ChunkRow view, so existing `row['text']` style access keeps working.
+    """
+    FIELDS = ('id', 'name', 'category', 'chapter', 'text')
+
+    def __init__(self, columns):
+        self.ids = _StringColumn(columns['id_buffer'], columns['id_offsets'])
+        self.texts = _StringColumn(columns['text_buffer'], columns['text_offsets'])
+        self.names = _DictColumn(columns['names'], columns['entry_ids'])
+        self.categories = _DictColumn(columns['categories'], columns['category_codes'])
+        self.chapters = _DictColumn(columns['chapters'], columns['chapter_codes'])
+
+    @classmethod
+    def from_records(cls, records):
+        ids = _StringColumn.from_strings([r['id'] for r in records])
+        texts = _StringColumn.from_strings([r['text'] for r in records])
+        names = _DictColumn.from_strings([r['name'] for r in records])
+        categories = _DictColumn.from_strings([r.get('category', '人物') for r in records])
+        chapters = _DictColumn.from_strings([r.get('chapter', r['name']) for r in records])
+        return cls({
+            'id_buffer': ids.buffer, 'id_offsets': ids.offsets,
+            'text_buffer': texts.buffer, 'text_offsets': texts.offsets,
+            'names': names.values, 'entry_ids': names.codes.astype(np.int32),
+            'categories': categories.values, 'category_codes': categories.codes,
+            'chapters': chapters.values, 'chapter_codes': chapters.codes,
+        })
+
+    def to_columns(self):
+        """Plain dict of bytes / list / ndarray, suitable for pickling into the index file"""
+        return {
+            'id_buffer': self.ids.buffer, 'id_offsets': self.ids.offsets,
+            'text_buffer': self.texts.buffer, 'text_offsets': self.texts.offsets,
+            'names': self.names.values, 'entry_ids': self.names.codes,
+            'categories': self.categories.values, 'category_codes': self.categories.codes,
+            'chapters': self.chapters.values, 'chapter_codes': self.chapters.codes,
+        }
+
+    @property
+    def entry_ids(self):
+        return self.names.codes
+
+    def __len__(self):
+        return len(self.names.codes)
+
+    def __getitem__(self, i):
+        return ChunkRow(self, int(i))
+
+    def __iter__(self):
+        return (ChunkRow(self, i) for i in range(len(self)))
+
+
+class ChunkRow:
+    """Read-only view of one chunk; fields are materialized from the columns on access"""
+    __slots__ = ('_table', '_idx')
+
+    def __init__(self, table, idx):
+        self._table = table
+        self._idx = idx
+
+    @property
+    def id(self): return self._table.ids[self._idx]
+
+    @property
+    def name(self): return self._table.names[self._idx]
+
+    @property
+    def category(self): return self._table.categories[self._idx]
+
+    @property
+    def chapter(self): return self._table.chapters[self._idx]
+
+    @property
+    def text(self): return self._table.texts[self._idx]
+
+    def __getitem__(self, key):
+        if key not in ChunkTable.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in ChunkTable.FIELDS else default
+
+    def __contains__(self, key):
+        return key in ChunkTable.FIELDS
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in ChunkTable.FIELDS}
+
+    def __repr__(self):
+        return f"ChunkRow({self.to_dict()!r})"
+
+
+class SearchResult:
+    """
+    One retrieval hit. Only (index, score) are stored; the chunk row and its vector are looked up
+    on access. Supports `result['data']` style access for compatibility with the old result dicts.
+    """
+    __slots__ = ('_data', '_embeddings', 'index', 'score')
+    KEYS = ('index', 'score', 'data', 'vector')
+
+    def __init__(self, data, embeddings, index, score):
+        self._data = data
+        self._embeddings = embeddings
+        self.index = int(index)
+        self.score = score
+
+    @property
+    def data(self): return self._data[self.index]
+
+    @property
+    def vector(self): return self._embeddings[self.index]
+
+    def __getitem__(self, key):
+        if key not in SearchResult.KEYS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key) if key in SearchResult.KEYS else default
@@ -1,5 +1,10 @@
 import os
-import pickle
+import re
+import time
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
 import numpy as np
 import requests
 import json
@@ -7,62 +12,133 @@ import zhconv
 import dashscope
 import jieba
 from http import HTTPStatus
-from sentence_transformers import SentenceTransformer
+from encoders import get_encoder_service
+from llm_scheduler import get_llm_scheduler, QueueFullError
+from index_store import get_index_manager
+from hierarchical_index import hierarchical_ranges, score_ranges
+from reduced_index import reduced_search
+from chunk_table import SearchResult
 import streamlit as st # Needed for st.cache_resource and st.session_state
 
 class HistoryEmbeddingLayer:
     """
     Layer 1: Historical Fact Embedding Layer
     Function: Loads "Ming Dynasty Historical Knowledge Graph Embedding Space", providing vectorization and retrieval capabilities.
+    search_mode: "flat" scores every chunk; "hierarchical" ranks entry centroids first and only scores
+    the chunks of the top `top_entries` entries, optionally narrowed to the best `top_chapters`
+    chapters (MINGYU_SEARCH_MODE / MINGYU_TOP_ENTRIES / MINGYU_TOP_CHAPTERS); "reduced" ranks
+    in the PCA-reduced space saved by `build_index.py --reduce-dim` and re-scores the best
+    `rerank_candidates` chunks with the full vectors (MINGYU_RERANK_CANDIDATES).
     """
-    def __init__(self, vector_file):
+    def __init__(self, vector_file, search_mode=None, top_entries=None, top_chapters=None, rerank_candidates=None):
         self.vector_file = vector_file
+        self.search_mode = search_mode or os.getenv('MINGYU_SEARCH_MODE', 'flat')
+        self.top_entries = top_entries or int(os.getenv('MINGYU_TOP_ENTRIES', 5))
+        if top_chapters is None and os.getenv('MINGYU_TOP_CHAPTERS'):
+            top_chapters = int(os.getenv('MINGYU_TOP_CHAPTERS'))
+        self.top_chapters = top_chapters
+        self.rerank_candidates = rerank_candidates or int(os.getenv('MINGYU_RERANK_CANDIDATES', 100))
         self.model = None
+        self.version = None
         self.db_data = None
         self.db_embeddings = None
+        self.knn_indices = None
+        self.knn_scores = None
+        self.hierarchy = None
+        self.projection = None
+        self.reduced_embeddings = None
         self._load_resources()
 
     def _load_resources(self):
-        # Use st.cache_resource to avoid reloading
+        # The encoder service is process-wide: concurrent sessions share one model and get micro-batched
         if 'model' not in st.session_state:
-            st.session_state.model = SentenceTransformer('BAAI/bge-small-zh-v1.5')
+            st.session_state.model = get_encoder_service()
         self.model = st.session_state.model
 
-        if not os.path.exists(self.vector_file):
+        # Index data is process-wide and hot-reloaded by a background watcher.
+        # Each layer (one Streamlit run) pins the snapshot that was current when it was created.
+        manager = get_index_manager(self.vector_file)
+        snapshot = manager.acquire()
+        if snapshot is None:
             # In a real app, we might raise an error or log it, but for Streamlit we use st.error
-            # However, to keep this logic pure, we should probably just print or raise exception
-            # But since it relies on st.session_state, it's tied to Streamlit.
             # We will keep the st.error for now as it is tightly coupled.
             if 'st' in globals():
                 st.error(f"Cannot find {self.vector_file}! Please run build_index.py first.")
             return
 
-        if 'db_data' not in st.session_state:
-            with open(self.vector_file, 'rb') as f:
-                data = pickle.load(f)
-                st.session_state.db_data = data['data']
-                st.session_state.db_embeddings = data['embeddings']
-        
-        self.db_data = st.session_state.db_data
-        self.db_embeddings = st.session_state.db_embeddings
+        # Hand the snapshot back once this layer is garbage-collected, so a retired version can be freed
+        weakref.finalize(self, manager.release, snapshot)
+        self.version = snapshot.version
+        self.db_data = snapshot.data
+        self.db_embeddings = snapshot.embeddings
+        # Older index files have no kNN graph; graph_search then falls back to a full scan
+        self.knn_indices = snapshot.knn_indices
+        self.knn_scores = snapshot.knn_scores
+        self.hierarchy = snapshot.hierarchy
+        self.projection = snapshot.projection
+        self.reduced_embeddings = snapshot.reduced_embeddings
 
     def encode(self, text):
-        return self.model.encode([text], normalize_embeddings=True)
+        return self.model.encode([text])
+
+    def _make_result(self, idx, score):
+        # Lightweight view: the chunk row and vector are only looked up when accessed
+        return SearchResult(self.db_data, self.db_embeddings, idx, score)
 
     def search(self, query_vec, top_k=3):
         if self.db_embeddings is None: return []
+        if self.search_mode == "hierarchical" and self.hierarchy is not None:
+            return self.hierarchical_search(query_vec, top_k=top_k)
+        if self.search_mode == "reduced" and self.projection is not None:
+            return self.reduced_search(query_vec, top_k=top_k)
         scores = np.dot(self.db_embeddings, query_vec.T).flatten()
         top_indices = np.argsort(scores)[::-1][:top_k]
         
         results = []
         for idx in top_indices:
-            results.append({
-                "score": scores[idx],
-                "data": self.db_data[idx],
-                "vector": self.db_embeddings[idx]
-            })
+            results.append(self._make_result(idx, scores[idx]))
         return results
 
+    def hierarchical_search(self, query_vec, top_k=3, top_entries=None, top_chapters=None):
+        """Coarse-to-fine: entry centroids -> (optionally) chapter centroids -> exact scores on the survivors"""
+        ranges = hierarchical_ranges(self.hierarchy, query_vec,
+                                     top_entries=top_entries or self.top_entries,
+                                     top_chapters=top_chapters or self.top_chapters)
+        candidates, scores = score_ranges(self.db_embeddings, ranges, query_vec)
+        order = np.argsort(scores)[::-1][:top_k]
+        return [self._make_result(candidates[i], scores[i]) for i in order]
+
+    def reduced_search(self, query_vec, top_k=3, candidates=None):
+        """Shortlist in the reduced space, then exact full-dimension scores on the shortlist"""
+        indices, scores = reduced_search(self.projection, self.reduced_embeddings, self.db_embeddings, query_vec,
+                                         top_k=top_k, candidates=candidates or self.rerank_candidates)
+        return [self._make_result(i, s) for i, s in zip(indices, scores)]
+
+    def neighbors(self, idx, k=None):
+        """Precomputed nearest chunks of chunk `idx` from the kNN graph, most similar first"""
+        if self.knn_indices is None: return []
+        k = k or self.knn_indices.shape[1]
+        return [self._make_result(j, s) for j, s in zip(self.knn_indices[idx][:k], self.knn_scores[idx][:k])]
+
+    def graph_search(self, query_vec, seeds, top_k=3, hops=2):
+        """
+        Walk the kNN graph `hops` steps out from the seed chunks and rank only the visited
+        chunks against query_vec: O(k^hops) dot products instead of O(N).
+        """
+        if self.knn_indices is None:
+            return self.search(query_vec, top_k=top_k)
+
+        visited = np.unique(np.asarray(seeds, dtype=np.int64))
+        frontier = visited
+        for _ in range(hops):
+            frontier = np.setdiff1d(self.knn_indices[frontier].ravel(), visited)
+            if len(frontier) == 0: break
+            visited = np.union1d(visited, frontier)
+
+        scores = np.dot(self.db_embeddings[visited], query_vec.T).flatten()
+        order = np.argsort(scores)[::-1][:top_k]
+        return [self._make_result(visited[i], scores[i]) for i in order]
+
 class ContextAlignmentLayer:
     """
     Layer 2: Institution-Context Alignment Layer
@@ -93,10 +169,12 @@ class FictionDiffusionLayer:
     def __init__(self, embedding_layer):
         self.emb_layer = embedding_layer
 
-    def interpolate_and_generate(self, fact_vec, query_vec, alpha=0.3, exclude_id=None):
+    def interpolate_and_generate(self, fact_vec, query_vec, alpha=0.3, exclude_id=None, anchor_index=None):
         """
         Constrained Diffusion in Embedding Space (Simulation)
         V_gen = (1 - alpha) * V_fact + alpha * V_query
+        If anchor_index is given, neighbours are found by walking the kNN graph from the anchor
+        instead of scanning the whole corpus.
         """
         # Vector interpolation
         gen_vec = (1 - alpha) * fact_vec + alpha * query_vec
@@ -107,7 +185,10 @@ class FictionDiffusionLayer:
             gen_vec = gen_vec / norm
             
         # Search for nearest "potential historical records"
-        results = self.emb_layer.search(gen_vec, top_k=10)
+        if anchor_index is not None:
+            results = self.emb_layer.graph_search(gen_vec, [anchor_index], top_k=10)
+        else:
+            results = self.emb_layer.search(gen_vec, top_k=10)
         
         # Exclude the anchor itself
         if exclude_id:
@@ -116,21 +197,128 @@ class FictionDiffusionLayer:
             
         return gen_vec, results
 
+def estimate_tokens(text):
+    """Rough Qwen token estimate: one token per CJK character/punctuation, ~4 characters per token otherwise"""
+    cjk = len(re.findall(r'[\u3000-\u303f\u4e00-\u9fff\uff00-\uffef]', text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+def truncate_to_tokens(text, budget):
+    """Longest prefix of text whose estimate_tokens() fits in budget"""
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= budget:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+def _bigrams(text):
+    return {text[i:i + 2] for i in range(len(text) - 1)} or {text}
+
+class ContextPacker:
+    """
+    Context Packing Layer
+    Function: Fits the anchor and neighbour chunks into a token budget before they reach the prompt.
+    Sentences are ranked by their chunk's similarity to the query vector (the embeddings we already
+    have) plus lexical overlap with the query; near-duplicate sentences across sources are dropped.
+    """
+    def __init__(self, token_budget=400, max_sources=3, dedup_threshold=0.8, lexical_weight=0.5):
+        self.token_budget = token_budget
+        self.max_sources = max_sources
+        self.dedup_threshold = dedup_threshold
+        self.lexical_weight = lexical_weight
+
+    @staticmethod
+    def split_sentences(text):
+        return [s for s in re.findall(r'[^。！？；]+[。！？；]?', text) if s.strip()]
+
+    def pack(self, query, query_vec, fact_item, nearby_results):
+        """
+        Returns (fact_text, context_texts): the packed anchor text and one packed text per neighbour source
+        """
+        sources = [fact_item] + list(nearby_results[:self.max_sources])
+        query_grams = _bigrams(query)
+
+        candidates = []
+        for src_idx, item in enumerate(sources):
+            sim = float(np.dot(item['vector'], np.ravel(query_vec)))
+            for sent_idx, sent in enumerate(self.split_sentences(item['data']['text'])):
+                lexical = len(query_grams & _bigrams(sent)) / len(query_grams)
+                candidates.append((sim + self.lexical_weight * lexical, src_idx, sent_idx, sent))
+
+        ranked = sorted(candidates, key=lambda c: -c[0])
+        # The best anchor sentence always goes first so the Fact section is never empty
+        best_anchor = next((c for c in ranked if c[1] == 0), None)
+        if best_anchor is not None:
+            ranked.remove(best_anchor)
+            ranked.insert(0, best_anchor)
+
+        kept = []
+        kept_grams = []
+        remaining = self.token_budget
+        for score, src_idx, sent_idx, sent in ranked:
+            cost = estimate_tokens(sent)
+            if cost > remaining:
+                if src_idx != 0 or kept:
+                    continue
+                # The best anchor sentence alone overflows the budget: cut it down rather than drop it
+                sent = truncate_to_tokens(sent, remaining)
+                cost = estimate_tokens(sent)
+            grams = _bigrams(sent)
+            if any(len(grams & g) / len(grams | g) >= self.dedup_threshold for g in kept_grams):
+                continue
+            kept.append((src_idx, sent_idx, sent))
+            kept_grams.append(grams)
+            remaining -= cost
+
+        # Reassemble in original reading order within each source
+        packed = [[] for _ in sources]
+        for src_idx, sent_idx, sent in sorted(kept):
+            packed[src_idx].append(sent)
+        fact_text = "".join(packed[0])
+        context_texts = ["".join(p) for p in packed[1:] if p]
+        return fact_text, context_texts
+
+def pack_context(packer, generation_layer, query, query_vec, fact_item, nearby_results, alpha):
+    """
+    Pack anchor + neighbour texts (packer=None keeps them verbatim).
+    Returns (fact_text, context_texts, report); report holds prompt token counts before/after packing.
+    """
+    raw_fact = fact_item['data']['text']
+    raw_context = [r['data']['text'] for r in nearby_results]
+    if packer is None:
+        fact_text, context_texts = raw_fact, raw_context
+    else:
+        fact_text, context_texts = packer.pack(query, query_vec, fact_item, nearby_results)
+    report = {
+        "tokens_before": estimate_tokens(generation_layer.build_prompt(query, raw_fact, raw_context, alpha)),
+        "tokens_after": estimate_tokens(generation_layer.build_prompt(query, fact_text, context_texts, alpha)),
+    }
+    return fact_text, context_texts, report
+
+GENERATION_ERROR_PREFIXES = ("⚠️", "⏳", "Generation failed", "Error calling LLM")
+
 class QwenGenerationLayer:
     """
     Layer 4: LLM Generation Layer
     Function: Generates pseudo-history text using Qwen based on interpolated context.
+    All calls go through a shared LLMScheduler (concurrency cap, fair queueing, retries).
     """
-    def __init__(self):
-        pass
+    def __init__(self, scheduler=None, session_id=None):
+        self.scheduler = scheduler
+        self.session_id = session_id
         
     def generate(self, query, fact_text, nearby_texts, alpha):
         """
         Call Qwen to generate pseudo-history
         """
-        if not dashscope.api_key:
-            return "⚠️ API Key not configured, cannot generate text."
-            
+        return self.generate_from_prompt(self.build_prompt(query, fact_text, nearby_texts, alpha))
+
+    def build_prompt(self, query, fact_text, nearby_texts, alpha):
+        """
+        Assemble the full Qwen prompt (pure function of its inputs, usable as a cache key)
+        """
         context_str = "\n".join([f"- {t}" for t in nearby_texts[:3]])
 
         # Extract keywords to enforce their presence in generation
@@ -158,20 +346,23 @@ class QwenGenerationLayer:
 
 请直接开始撰写正文：
 """
-        
+        return prompt
+
+    def generate_from_prompt(self, prompt):
+        scheduler = self.scheduler or get_llm_scheduler()
+        if scheduler.backend.requires_api_key and not dashscope.api_key:
+            return "⚠️ API Key not configured, cannot generate text."
+
         try:
-            response = dashscope.Generation.call(
-                dashscope.Generation.Models.qwen_plus,
-                prompt=prompt,
-                temperature=0.7,
-                top_p=0.85
-            )
+            response = scheduler.submit(prompt, session_id=self.session_id).result()
             
             if response.status_code == HTTPStatus.OK:
-                return response.output.text
+                return response.text
             else:
                 return f"Generation failed: {response.code} - {response.message}"
                 
+        except QueueFullError as e:
+            return f"⏳ Queue full, please retry shortly: {str(e)}"
         except Exception as e:
             return f"Error calling LLM: {str(e)}"
 
@@ -214,10 +405,14 @@ class ExternalKnowledgeLayer:
     """
     External Knowledge Layer
     Function: Fetches data from external sources like CBDB.
+    MINGYU_CBDB_BACKEND=stub skips the network and returns a placeholder record after
+    MINGYU_CBDB_STUB_LATENCY_MS (offline load tests).
     """
     @staticmethod
     def get_cbdb_bio(name_cn):
         """Fetch structured data from Harvard CBDB"""
+        if os.getenv('MINGYU_CBDB_BACKEND') == 'stub':
+            return ExternalKnowledgeLayer._stub_cbdb_bio(name_cn)
         try:
             name_trad = zhconv.convert(name_cn, 'zh-hant')
             url = "https://cbdb.fas.harvard.edu/cbdbapi/person.php"
@@ -244,3 +439,140 @@ class ExternalKnowledgeLayer:
             }
         except:
             return None
+
+    @staticmethod
+    def _stub_cbdb_bio(name_cn):
+        time.sleep(float(os.getenv('MINGYU_CBDB_STUB_LATENCY_MS', 300)) / 1000.0)
+        return {"name": name_cn, "birth": '?', "death": '?', "dynasty": '明', "native": '未知', "id": 'stub'}
+
+class StageCache:
+    """
+    Bounded LRU cache for one pipeline stage
+    Function: Maps an explicit stage key to its computed value, evicting the least recently used entry.
+    Thread-safe; compute() runs outside the lock so independent stages can run concurrently.
+    """
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_compute(self, key, compute, should_cache=None):
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+            self.misses += 1
+        value = compute()
+        if should_cache is not None and not should_cache(value):
+            return value
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._entries)
+
+class CachedPipeline:
+    """
+    Dependency-aware chain of cached stages
+    Function: Lets Streamlit reruns recompute only the stages whose inputs changed.
+      query_embedding, anchor  <- query
+      diffusion                <- query, alpha
+      projection               <- query, alpha (PCA inputs)
+      packing                  <- query, alpha (anchor + neighbour texts)
+      generation               <- full prompt text
+      cbdb                     <- person name
+    The pipeline outlives a run (it sits in session state), so it must not pin an index version:
+    retrieval stages cache (index, score) pairs and rebuild result views from the bound layer,
+    and release() drops the layers at the end of each run.
+    """
+    STAGES = ('query_embedding', 'anchor', 'diffusion', 'projection', 'packing', 'generation', 'cbdb')
+    # Stages whose results point into a specific index version
+    INDEX_STAGES = ('anchor', 'diffusion', 'projection', 'packing')
+
+    def __init__(self, emb_layer, diffusion_layer, generation_layer, packer=None, max_entries=32):
+        self.emb_layer = emb_layer
+        self.diffusion_layer = diffusion_layer
+        self.generation_layer = generation_layer
+        self.packer = packer
+        self.caches = {name: StageCache(max_entries) for name in self.STAGES}
+        self.index_version = getattr(emb_layer, 'version', None)
+
+    def bind(self, emb_layer, diffusion_layer, generation_layer):
+        """
+        Point the pipeline at this run's layers. If the index was hot-reloaded in between,
+        drop the index-dependent stages (query embeddings and generations stay valid).
+        """
+        self.emb_layer = emb_layer
+        self.diffusion_layer = diffusion_layer
+        self.generation_layer = generation_layer
+        version = getattr(emb_layer, 'version', None)
+        if version != self.index_version:
+            for name in self.INDEX_STAGES:
+                self.caches[name] = StageCache(self.caches[name].max_entries)
+            self.index_version = version
+
+    def release(self):
+        """
+        Drop this run's layers. The embedding layer holds the index snapshot until it is
+        garbage-collected, so an idle session would otherwise keep a retired version alive.
+        """
+        self.emb_layer = None
+        self.diffusion_layer = None
+        self.generation_layer = None
+
+    def run(self, stage, key, compute, should_cache=None):
+        return self.caches[stage].get_or_compute(key, compute, should_cache)
+
+    def query_embedding(self, query):
+        return self.run('query_embedding', query, lambda: self.emb_layer.encode(query))
+
+    def anchor(self, query):
+        def compute():
+            hit = self.emb_layer.search(self.query_embedding(query), top_k=1)[0]
+            return hit['index'], hit['score']
+        return self.emb_layer._make_result(*self.run('anchor', query, compute))
+
+    def diffusion(self, query, alpha):
+        def compute():
+            fact_item = self.anchor(query)
+            gen_vec, results = self.diffusion_layer.interpolate_and_generate(
+                fact_item['vector'],
+                self.query_embedding(query),
+                alpha,
+                exclude_id=fact_item['data']['id'],
+                anchor_index=fact_item.get('index')
+            )
+            return gen_vec, [(r['index'], r['score']) for r in results]
+        gen_vec, hits = self.run('diffusion', (query, alpha), compute)
+        return gen_vec, [self.emb_layer._make_result(idx, score) for idx, score in hits]
+
+    def packing(self, query, alpha):
+        """
+        Returns (fact_text, context_texts, report); report holds prompt token counts before/after packing
+        """
+        def compute():
+            _, nearby_results = self.diffusion(query, alpha)
+            return pack_context(self.packer, self.generation_layer, query, self.query_embedding(query),
+                                self.anchor(query), nearby_results, alpha)
+        return self.run('packing', (query, alpha), compute)
+
+    def generation(self, query, fact_text, nearby_texts, alpha):
+        prompt = self.generation_layer.build_prompt(query, fact_text, nearby_texts, alpha)
+        key = hashlib.sha256(prompt.encode('utf-8')).hexdigest()
+        # Failed calls come back as status strings; don't pin them in the cache
+        return self.run('generation', key, lambda: self.generation_layer.generate_from_prompt(prompt),
+                        should_cache=lambda text: not text.startswith(GENERATION_ERROR_PREFIXES))
+
+    def cbdb(self, name):
+        # get_cbdb_bio returns None on any failure (including timeouts); retry those on the next run
+        return self.run('cbdb', name, lambda: ExternalKnowledgeLayer.get_cbdb_bio(name),
+                        should_cache=lambda bio: bio is not None)
+
+    def stats(self):
+        return {name: {"hits": c.hits, "misses": c.misses, "size": len(c)} for name, c in self.caches.items()}
@@ -0,0 +1,335 @@
+import os
+import time
+import queue
+import hashlib
+import threading
+from concurrent.futures import Future
+import numpy as np
+
+MODEL_NAME = 'BAAI/bge-small-zh-v1.5'
+DEFAULT_ONNX_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'onnx_bge_small')
+
+
+def _normalize(vecs):
+    norms = np.linalg.norm(vecs, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (vecs / norms).astype(np.float32)
+
+
+class EncoderBackend:
+    """
+    Encoder Backend Interface
+    Function: Turns a list of texts into an (n, dim) float32 matrix of L2-normalized embeddings.
+    """
+    name = "base"
+
+    def encode(self, texts, batch_size=32):
+        raise NotImplementedError
+
+
+class SentenceTransformerBackend(EncoderBackend):
+    """Reference backend: PyTorch eager mode through sentence-transformers."""
+    name = "sentence-transformers"
+
+    def __init__(self, model_name=MODEL_NAME, num_threads=None):
+        if num_threads:
+            import torch
+            torch.set_num_threads(num_threads)
+        from sentence_transformers import SentenceTransformer
+        self.model = SentenceTransformer(model_name)
+
+    def encode(self, texts, batch_size=32):
+        vecs = self.model.encode(list(texts), batch_size=batch_size, normalize_embeddings=True)
+        return np.asarray(vecs, dtype=np.float32)
+
+
+class OnnxBackend(EncoderBackend):
+    """
+    CPU backend: exported (optionally int8-quantized) ONNX graph run by onnxruntime.
+    Uses CLS pooling + L2 normalization, same as the bge sentence-transformers config.
+    """
+    name = "onnx"
+
+    def __init__(self, model_dir=DEFAULT_ONNX_DIR, num_threads=None, quantized=True, max_length=512):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_file = os.path.join(model_dir, 'model_int8.onnx' if quantized else 'model.onnx')
+        if not os.path.exists(model_file):
+            raise FileNotFoundError(f"Cannot find {model_file}! Please run `python encoders.py export` first.")
+
+        options = ort.SessionOptions()
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_length = max_length
+
+    def encode(self, texts, batch_size=32):
+        texts = list(texts)
+        outputs = []
+        for start in range(0, len(texts), batch_size):
+            batch = self.tokenizer(texts[start:start + batch_size], padding=True, truncation=True,
+                                   max_length=self.max_length, return_tensors='np')
+            feed = {k: v.astype(np.int64) for k, v in batch.items() if k in self.input_names}
+            last_hidden = self.session.run(None, feed)[0]
+            outputs.append(last_hidden[:, 0])
+        if not outputs:
+            return np.zeros((0, 0), dtype=np.float32)
+        return _normalize(np.vstack(outputs))
+
+
+class HashingEncoderBackend(EncoderBackend):
+    """
+    Deterministic stub backend for tests: character uni/bi-gram feature hashing.
+    No model download, stable across processes (md5 instead of the salted builtin hash).
+    latency_ms simulates the model's forward-pass time per encode() call, for load tests.
+    """
+    name = "hash"
+
+    def __init__(self, dim=512, latency_ms=0):
+        self.dim = dim
+        self.latency = latency_ms / 1000.0
+
+    def _features(self, text):
+        grams = list(text) + [text[i:i + 2] for i in range(len(text) - 1)]
+        for gram in grams:
+            digest = hashlib.md5(gram.encode('utf-8')).digest()
+            bucket = int.from_bytes(digest[:4], 'little') % self.dim
+            sign = 1.0 if digest[4] & 1 else -1.0
+            yield bucket, sign
+
+    def encode(self, texts, batch_size=32):
+        texts = list(texts)
+        if self.latency:
+            time.sleep(self.latency)
+        vecs = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for bucket, sign in self._features(text):
+                vecs[row, bucket] += sign
+        return _normalize(vecs)
+
+
+class MicroBatchEncoder(EncoderBackend):
+    """
+    Encoder Service
+    Function: Collects concurrent single-text requests for up to max_wait_ms or max_batch_size items,
+    runs one batched forward pass on the wrapped backend and fans the rows back out through futures.
+    """
+    name = "micro-batch"
+
+    def __init__(self, backend, max_batch_size=32, max_wait_ms=5.0):
+        self.backend = backend
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._last_batch_size = 0
+        self._largest_batch = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._total_forward = 0.0
+        self._worker = threading.Thread(target=self._run, name="encoder-service", daemon=True)
+        self._worker.start()
+
+    def submit(self, text):
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def encode(self, texts, batch_size=32):
+        futures = [self.submit(t) for t in texts]
+        return np.vstack([f.result() for f in futures])
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    def _collect(self, first):
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is None:
+                # Re-post the stop sentinel so the loop exits after this batch
+                self._queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while True:
+            first = self._queue.get()
+            if first is None:
+                return
+            batch = self._collect(first)
+            texts = [text for text, _, _ in batch]
+            started = time.perf_counter()
+            try:
+                vecs = self.backend.encode(texts, batch_size=len(texts))
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            finished = time.perf_counter()
+
+            waits = [started - enqueued for _, _, enqueued in batch]
+            with self._lock:
+                self._batches += 1
+                self._items += len(batch)
+                self._last_batch_size = len(batch)
+                self._largest_batch = max(self._largest_batch, len(batch))
+                self._total_wait += sum(waits)
+                self._max_wait_seen = max(self._max_wait_seen, max(waits))
+                self._total_forward += finished - started
+
+            for row, (_, future, _) in enumerate(batch):
+                future.set_result(vecs[row:row + 1])
+
+    def metrics(self):
+        with self._lock:
+            batches = max(self._batches, 1)
+            items = max(self._items, 1)
+            return {
+                "queue_depth": self._queue.qsize(),
+                "batches": self._batches,
+                "items": self._items,
+                "last_batch_size": self._last_batch_size,
+                "mean_batch_size": self._items / batches,
+                "max_batch_size": self._largest_batch,
+                "mean_wait_ms": self._total_wait / items * 1000,
+                "max_wait_ms": self._max_wait_seen * 1000,
+                "mean_forward_ms": self._total_forward / batches * 1000,
+            }
+
+
+def export_onnx_model(model_name=MODEL_NAME, out_dir=DEFAULT_ONNX_DIR, quantize=True):
+    """Export the transformer behind the sentence-transformers model to ONNX, then int8-quantize it."""
+    import torch
+    from sentence_transformers import SentenceTransformer
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    os.makedirs(out_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device='cpu')
+    hf_model = st_model[0].auto_model.eval()
+    tokenizer = st_model.tokenizer
+    tokenizer.save_pretrained(out_dir)
+
+    dummy = tokenizer(["明太祖朱元璋"], return_tensors='pt')
+    input_names = ['input_ids', 'attention_mask', 'token_type_ids']
+    dynamic_axes = {name: {0: 'batch', 1: 'seq'} for name in input_names}
+    dynamic_axes['last_hidden_state'] = {0: 'batch', 1: 'seq'}
+
+    fp32_path = os.path.join(out_dir, 'model.onnx')
+    with torch.no_grad():
+        torch.onnx.export(
+            hf_model,
+            (dummy['input_ids'], dummy['attention_mask'], dummy['token_type_ids']),
+            fp32_path,
+            input_names=input_names,
+            output_names=['last_hidden_state'],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+        )
+
+    if quantize:
+        quantize_dynamic(fp32_path, os.path.join(out_dir, 'model_int8.onnx'), weight_type=QuantType.QInt8)
+    return out_dir
+
+
+def parity_check(reference, candidate, texts, threshold=0.98):
+    """Row-wise cosine agreement between two backends on the same texts."""
+    ref = reference.encode(texts)
+    cand = candidate.encode(texts)
+    cos = np.sum(_normalize(ref) * _normalize(cand), axis=1)
+    return {
+        "min_cosine": float(cos.min()),
+        "mean_cosine": float(cos.mean()),
+        "passed": bool(cos.min() >= threshold),
+    }
+
+
+def load_encoder(backend=None, num_threads=None, model_dir=None):
+    """
+    Build an encoder backend from arguments or environment:
+    MINGYU_ENCODER (sentence-transformers | onnx | onnx-fp32 | hash), MINGYU_ENCODER_THREADS, MINGYU_ONNX_DIR,
+    MINGYU_ENCODER_STUB_LATENCY_MS (hash backend only)
+    """
+    backend = backend or os.getenv('MINGYU_ENCODER', SentenceTransformerBackend.name)
+    if num_threads is None and os.getenv('MINGYU_ENCODER_THREADS'):
+        num_threads = int(os.getenv('MINGYU_ENCODER_THREADS'))
+    model_dir = model_dir or os.getenv('MINGYU_ONNX_DIR', DEFAULT_ONNX_DIR)
+
+    if backend == SentenceTransformerBackend.name:
+        return SentenceTransformerBackend(num_threads=num_threads)
+    if backend == OnnxBackend.name:
+        return OnnxBackend(model_dir, num_threads=num_threads, quantized=True)
+    if backend == 'onnx-fp32':
+        return OnnxBackend(model_dir, num_threads=num_threads, quantized=False)
+    if backend == HashingEncoderBackend.name:
+        return HashingEncoderBackend(latency_ms=float(os.getenv('MINGYU_ENCODER_STUB_LATENCY_MS', 0)))
+    raise ValueError(f"Unknown encoder backend: {backend}")
+
+
+_service = None
+_service_lock = threading.Lock()
+
+
+def get_encoder_service():
+    """
+    Process-wide MicroBatchEncoder shared by all Streamlit sessions.
+    Tunables: MINGYU_ENCODER_BATCH (max items per forward pass), MINGYU_ENCODER_WAIT_MS (max collect window)
+    """
+    global _service
+    with _service_lock:
+        if _service is None:
+            _service = MicroBatchEncoder(
+                load_encoder(),
+                max_batch_size=int(os.getenv('MINGYU_ENCODER_BATCH', 32)),
+                max_wait_ms=float(os.getenv('MINGYU_ENCODER_WAIT_MS', 5)),
+            )
+    return _service
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Export / verify the ONNX encoder backend")
+    parser.add_argument('command', choices=['export', 'parity'])
+    parser.add_argument('--out-dir', default=DEFAULT_ONNX_DIR)
+    parser.add_argument('--no-quantize', action='store_true')
+    parser.add_argument('--threads', type=int, default=None)
+    parser.add_argument('--threshold', type=float, default=0.98)
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_onnx_model(out_dir=args.out_dir, quantize=not args.no_quantize)
+        print(f"💾 ONNX 模型已导出至: {args.out_dir}")
+    else:
+        sample = [
+            "假如张居正支持万历皇帝彻底清算冯保",
+            "土木堡之变，英宗被俘，于谦力主守卫北京。",
+            "锦衣卫与东厂并称厂卫，掌侍卫、缉捕、刑狱之事。",
+            "郑和七下西洋，船队远至东非。",
+        ]
+        reference = SentenceTransformerBackend(num_threads=args.threads)
+        candidate = OnnxBackend(args.out_dir, num_threads=args.threads, quantized=not args.no_quantize)
+        for backend in (reference, candidate):
+            start = time.perf_counter()
+            backend.encode(sample * 8)
+            print(f"⏱ {backend.name}: {(time.perf_counter() - start) * 1000:.1f} ms / {len(sample) * 8} texts")
+        report = parity_check(reference, candidate, sample, threshold=args.threshold)
+        print(f"📊 余弦一致性: min={report['min_cosine']:.4f} mean={report['mean_cosine']:.4f}")
+        if not report['passed']:
+            raise SystemExit(f"❌ 一致性低于阈值 {args.threshold}")
+        print("✅ 一致性校验通过")
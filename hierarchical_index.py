@@ -0,0 +1,128 @@
+import time
+import itertools
+import numpy as np
+
+
+def _group_centroids(embeddings, group_of_chunk, n_groups):
+    sums = np.zeros((n_groups, embeddings.shape[1]), dtype=np.float64)
+    np.add.at(sums, group_of_chunk, embeddings)
+    norms = np.linalg.norm(sums, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return (sums / norms).astype(np.float32)
+
+
+def build_hierarchy(db_data, embeddings):
+    """
+    Per-entry (source file `name`) and per-chapter centroid vectors for coarse-to-fine search.
+    Chunks are stored file by file, so a chapter is a contiguous run of chunks with the same
+    (name, chapter); chapter c covers chunks chapter_start[c]:chapter_start[c + 1].
+    Chunks missing a `chapter` field (older indexes) form one chapter per entry.
+    """
+    entry_names, entry_ids = {}, []
+    chapter_names, chapter_entry, chapter_ids = [], [], []
+    previous = None
+    for item in db_data:
+        entry = entry_names.setdefault(item['name'], len(entry_names))
+        key = (entry, item.get('chapter', item['name']))
+        if key != previous:
+            chapter_names.append(key[1])
+            chapter_entry.append(entry)
+            previous = key
+        entry_ids.append(entry)
+        chapter_ids.append(len(chapter_names) - 1)
+
+    chapter_of_chunk = np.asarray(chapter_ids, dtype=np.int64)
+    chapter_start = np.concatenate([[0], np.cumsum(np.bincount(chapter_of_chunk, minlength=len(chapter_names)))])
+
+    return {
+        "entry_names": list(entry_names),
+        "entry_centroids": _group_centroids(embeddings, np.asarray(entry_ids), len(entry_names)),
+        "chapter_names": chapter_names,
+        "chapter_entry": np.asarray(chapter_entry, dtype=np.int32),
+        "chapter_centroids": _group_centroids(embeddings, chapter_of_chunk, len(chapter_names)),
+        "chapter_start": chapter_start.astype(np.int64),
+    }
+
+
+def hierarchical_ranges(hierarchy, query_vec, top_entries=5, top_chapters=None):
+    """
+    Coarse stages: rank entries by centroid, keep the top `top_entries`; within them optionally keep
+    only the `top_chapters` best chapters. Returns the surviving chunks as merged [start, end) runs.
+    """
+    q = np.ravel(query_vec)
+    entry_scores = hierarchy["entry_centroids"] @ q
+    top_entries = min(top_entries, len(entry_scores))
+    kept_entries = np.argpartition(-entry_scores, top_entries - 1)[:top_entries]
+
+    chapters = np.flatnonzero(np.isin(hierarchy["chapter_entry"], kept_entries))
+    if top_chapters is not None and len(chapters) > top_chapters:
+        chapter_scores = hierarchy["chapter_centroids"][chapters] @ q
+        chapters = np.sort(chapters[np.argpartition(-chapter_scores, top_chapters - 1)[:top_chapters]])
+
+    # Adjacent chapters merge into one run, so a whole entry is usually a single slice
+    bounds = hierarchy["chapter_start"]
+    starts, ends = bounds[chapters], bounds[chapters + 1]
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    return list(zip(starts[np.r_[0, breaks]], ends[np.r_[breaks - 1, len(ends) - 1]]))
+
+
+def score_ranges(embeddings, ranges, query_vec):
+    """Exact scores for the chunks in `ranges`, computed on contiguous slices (no gather copy)"""
+    q = np.ravel(query_vec)
+    indices = np.concatenate([np.arange(start, end) for start, end in ranges])
+    scores = np.concatenate([embeddings[start:end] @ q for start, end in ranges])
+    return indices, scores
+
+
+def sample_queries(embeddings, n_queries=200, noise=0.8, seed=0):
+    """
+    Benchmark queries: corpus chunks perturbed with Gaussian noise, so their exact neighbours
+    are not just themselves.
+    """
+    rng = np.random.default_rng(seed)
+    picks = rng.choice(len(embeddings), size=min(n_queries, len(embeddings)), replace=False)
+    queries = embeddings[picks] + rng.normal(scale=noise / np.sqrt(embeddings.shape[1]), size=(len(picks), embeddings.shape[1]))
+    return (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+
+
+def flat_top_k(embeddings, queries, top_k=10):
+    """Exact top-k sets from a per-query full scan, plus its mean latency in ms (the flat baseline)"""
+    start = time.perf_counter()
+    truth = []
+    for q in queries:
+        scores = embeddings @ q
+        truth.append(set(np.argpartition(-scores, top_k - 1)[:top_k]))
+    return truth, (time.perf_counter() - start) / len(queries) * 1000
+
+
+def benchmark_hierarchy(embeddings, hierarchy, top_k=10, entry_options=(1, 3, 5, 10, 20),
+                        chapter_options=(None, 50), n_queries=200, noise=0.8, seed=0, queries=None):
+    """
+    Latency and recall@k of hierarchical vs. flat search. `queries` are real encoded query
+    vectors (e.g. user hypotheses); without them, noisy corpus chunks stand in.
+    """
+    if queries is None:
+        queries = sample_queries(embeddings, n_queries=n_queries, noise=noise, seed=seed)
+    truth, flat_ms = flat_top_k(embeddings, queries, top_k=top_k)
+
+    rows = [{"mode": "flat", "top_entries": None, "top_chapters": None, "latency_ms": flat_ms,
+             "recall": 1.0, "candidates": len(embeddings)}]
+    for top_entries, top_chapters in itertools.product(entry_options, chapter_options):
+        hits, candidates = 0, 0
+        start = time.perf_counter()
+        for q, expected in zip(queries, truth):
+            ranges = hierarchical_ranges(hierarchy, q, top_entries=top_entries, top_chapters=top_chapters)
+            cand, scores = score_ranges(embeddings, ranges, q)
+            k = min(top_k, len(cand))
+            found = cand[np.argpartition(-scores, k - 1)[:k]]
+            hits += len(expected & set(found))
+            candidates += len(cand)
+        rows.append({
+            "mode": "hierarchical",
+            "top_entries": top_entries,
+            "top_chapters": top_chapters,
+            "latency_ms": (time.perf_counter() - start) / len(queries) * 1000,
+            "recall": hits / (len(queries) * top_k),
+            "candidates": candidates / len(queries),
+        })
+    return rows
@@ -0,0 +1,178 @@
+import os
+import glob
+import pickle
+import threading
+from datetime import datetime
+from chunk_table import ChunkTable
+
+VERSIONS_DIR = 'index_versions'
+POINTER_FILE = 'CURRENT'
+
+
+def versions_dir_for(vector_file):
+    return os.path.join(os.path.dirname(os.path.abspath(vector_file)), VERSIONS_DIR)
+
+
+def publish_index(payload, vector_file, keep=3):
+    """
+    Write a new immutable index version and atomically repoint CURRENT at it.
+    Readers either see the old pointer or the new one, never a half-written file.
+    Returns the new version name.
+    """
+    versions_dir = versions_dir_for(vector_file)
+    os.makedirs(versions_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(vector_file))[0]
+    version = datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+    file_name = f"{stem}-{version}.pkl"
+
+    tmp_path = os.path.join(versions_dir, f".{file_name}.tmp")
+    with open(tmp_path, 'wb') as f:
+        pickle.dump(payload, f)
+    os.replace(tmp_path, os.path.join(versions_dir, file_name))
+
+    tmp_pointer = os.path.join(versions_dir, f".{POINTER_FILE}.tmp")
+    with open(tmp_pointer, 'w', encoding='utf-8') as f:
+        f.write(file_name)
+    os.replace(tmp_pointer, os.path.join(versions_dir, POINTER_FILE))
+
+    # Old versions already loaded by a running app live in memory, so pruning the files is safe
+    old_files = sorted(glob.glob(os.path.join(versions_dir, f"{stem}-*.pkl")))[:-keep]
+    for path in old_files:
+        os.remove(path)
+    return version
+
+
+def resolve_current(vector_file):
+    """Path of the current index version, falling back to the legacy single-file index"""
+    versions_dir = versions_dir_for(vector_file)
+    pointer = os.path.join(versions_dir, POINTER_FILE)
+    if os.path.exists(pointer):
+        with open(pointer, encoding='utf-8') as f:
+            path = os.path.join(versions_dir, f.read().strip())
+        if os.path.exists(path):
+            return path
+    if os.path.exists(vector_file):
+        return vector_file
+    return None
+
+
+class IndexSnapshot:
+    """One loaded, immutable index version"""
+    def __init__(self, path, payload):
+        self.path = path
+        self.version = os.path.basename(path)
+        # Older index files store metadata as a list of dicts; convert once at load time
+        if 'columns' in payload:
+            self.data = ChunkTable(payload['columns'])
+        else:
+            self.data = ChunkTable.from_records(payload['data'])
+        self.embeddings = payload['embeddings']
+        # Older index files have no kNN graph
+        self.knn_indices = payload.get('knn_indices')
+        self.knn_scores = payload.get('knn_scores')
+        self.hierarchy = payload.get('hierarchy')
+        # Present only when the index was built with --reduce-dim
+        self.projection = payload.get('projection')
+        self.reduced_embeddings = payload.get('reduced_embeddings')
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            return cls(path, pickle.load(f))
+
+
+class IndexManager:
+    """
+    Hot-reloadable Index
+    Function: Serves the current IndexSnapshot to new requests. A background watcher loads a newly
+    published version alongside the old one and swaps it in atomically; the old snapshot is dropped
+    once every request that acquired it has released it.
+    """
+    def __init__(self, vector_file, poll_interval=5.0):
+        self.vector_file = vector_file
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._refs = {}
+        self._retired = {}
+        self._watcher = None
+        self._stop = threading.Event()
+        path = resolve_current(vector_file)
+        self._current = IndexSnapshot.load(path) if path else None
+
+    @property
+    def current(self):
+        return self._current
+
+    def acquire(self):
+        with self._lock:
+            snapshot = self._current
+            if snapshot is not None:
+                self._refs[snapshot.version] = self._refs.get(snapshot.version, 0) + 1
+            return snapshot
+
+    def release(self, snapshot):
+        if snapshot is None:
+            return
+        with self._lock:
+            self._refs[snapshot.version] -= 1
+            if self._refs[snapshot.version] == 0:
+                del self._refs[snapshot.version]
+                self._retired.pop(snapshot.version, None)
+
+    def check_for_update(self):
+        """Load and swap in the version CURRENT points at, if it changed. Returns True on swap."""
+        path = resolve_current(self.vector_file)
+        current = self._current
+        if path is None or (current is not None and path == current.path):
+            return False
+
+        # Load outside the lock: in-flight searches keep using the old snapshot meanwhile
+        new_snapshot = IndexSnapshot.load(path)
+        with self._lock:
+            old = self._current
+            self._current = new_snapshot
+            if old is not None and self._refs.get(old.version):
+                self._retired[old.version] = old
+        return True
+
+    def start_watcher(self):
+        if self._watcher is not None:
+            return
+        self._watcher = threading.Thread(target=self._watch, name="index-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self):
+        self._stop.set()
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self.check_for_update()
+            except Exception as e:
+                # A broken or half-copied artifact must not take the app down; retry on the next poll
+                print(f"Index reload failed: {e}")
+
+    def status(self):
+        with self._lock:
+            return {
+                "current": self._current.version if self._current else None,
+                "refs": dict(self._refs),
+                "retired": list(self._retired),
+            }
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_index_manager(vector_file):
+    """Process-wide IndexManager per index path, with its watcher running (MINGYU_INDEX_POLL_SECONDS)"""
+    with _managers_lock:
+        if vector_file not in _managers:
+            manager = IndexManager(vector_file, poll_interval=float(os.getenv('MINGYU_INDEX_POLL_SECONDS', 5)))
+            manager.start_watcher()
+            _managers[vector_file] = manager
+        return _managers[vector_file]
@@ -0,0 +1,243 @@
+import os
+import time
+import random
+import threading
+from collections import OrderedDict, deque, namedtuple
+from concurrent.futures import Future
+from http import HTTPStatus
+
+LLMResponse = namedtuple('LLMResponse', ['status_code', 'text', 'code', 'message'])
+
+# DashScope error codes (and plain HTTP 429) that mean "slow down and try again"
+THROTTLING_CODES = {'Throttling', 'Throttling.RateQuota', 'Throttling.AllocationQuota', 'Throttling.User'}
+
+
+class QueueFullError(Exception):
+    """Raised by LLMScheduler.submit when the shared queue is at capacity (load shedding)."""
+
+
+def is_throttled(response):
+    return response.status_code == HTTPStatus.TOO_MANY_REQUESTS or response.code in THROTTLING_CODES
+
+
+class DashScopeBackend:
+    """Qwen-Plus through dashscope.Generation.call"""
+    name = "dashscope"
+    requires_api_key = True
+
+    def __init__(self, temperature=0.7, top_p=0.85):
+        self.temperature = temperature
+        self.top_p = top_p
+
+    def call(self, prompt):
+        import dashscope
+        response = dashscope.Generation.call(
+            dashscope.Generation.Models.qwen_plus,
+            prompt=prompt,
+            temperature=self.temperature,
+            top_p=self.top_p
+        )
+        if response.status_code == HTTPStatus.OK:
+            return LLMResponse(response.status_code, response.output.text, None, None)
+        return LLMResponse(response.status_code, None, response.code, response.message)
+
+
+class StubLLMBackend:
+    """
+    Local stand-in for offline load tests: sleeps for a configurable latency and
+    throttles a configurable fraction of calls, no network or API key needed.
+    """
+    name = "stub"
+    requires_api_key = False
+
+    def __init__(self, latency_ms=200, jitter_ms=0, throttle_rate=0.0, seed=None):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.throttle_rate = throttle_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+
+    def call(self, prompt):
+        with self._lock:
+            self.calls += 1
+            throttled = self._rng.random() < self.throttle_rate
+            delay = self.latency + self._rng.uniform(0, self.jitter)
+        time.sleep(delay)
+        if throttled:
+            return LLMResponse(HTTPStatus.TOO_MANY_REQUESTS, None, 'Throttling.RateQuota', 'Requests rate limit exceeded')
+        return LLMResponse(HTTPStatus.OK, f"【模拟生成】{prompt.strip()[:60]}……", None, None)
+
+
+class LLMScheduler:
+    """
+    Shared LLM Request Scheduler
+    Function: Caps in-flight provider calls, serves sessions round-robin from per-session queues,
+    retries throttled calls with exponential backoff and sheds load once the queue is full.
+    """
+    def __init__(self, backend, max_in_flight=4, max_queue=32, max_retries=3, base_delay=0.5, max_delay=8.0):
+        self.backend = backend
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        self._cond = threading.Condition()
+        self._queues = OrderedDict()  # session_id -> deque of (prompt, future, enqueued_at)
+        self._queued = 0
+        self._in_flight = 0
+        self._stopped = False
+        self._stats = {"submitted": 0, "completed": 0, "failed": 0, "rejected": 0, "retries": 0, "total_wait": 0.0}
+
+        self._workers = [threading.Thread(target=self._run, name=f"llm-worker-{i}", daemon=True)
+                         for i in range(max_in_flight)]
+        for worker in self._workers:
+            worker.start()
+
+    def submit(self, prompt, session_id=None):
+        future = Future()
+        with self._cond:
+            if self._queued >= self.max_queue:
+                self._stats["rejected"] += 1
+                raise QueueFullError(f"LLM queue full ({self._queued}/{self.max_queue} waiting)")
+            self._queues.setdefault(session_id, deque()).append((prompt, future, time.perf_counter()))
+            self._queued += 1
+            self._stats["submitted"] += 1
+            self._cond.notify()
+        return future
+
+    def close(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for worker in self._workers:
+            worker.join()
+
+    def _next_job(self):
+        # Round-robin: take from the first session, then move it to the back of the line
+        session_id, jobs = next(iter(self._queues.items()))
+        job = jobs.popleft()
+        del self._queues[session_id]
+        if jobs:
+            self._queues[session_id] = jobs
+        self._queued -= 1
+        return job
+
+    def _call_with_retries(self, prompt):
+        attempt = 0
+        while True:
+            response = self.backend.call(prompt)
+            if not is_throttled(response) or attempt >= self.max_retries:
+                return response
+            delay = min(self.base_delay * (2 ** attempt), self.max_delay)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+            attempt += 1
+            with self._cond:
+                self._stats["retries"] += 1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queued and not self._stopped:
+                    self._cond.wait()
+                if self._stopped and not self._queued:
+                    return
+                prompt, future, enqueued = self._next_job()
+                self._in_flight += 1
+                self._stats["total_wait"] += time.perf_counter() - enqueued
+
+            try:
+                response = self._call_with_retries(prompt)
+            except Exception as e:
+                future.set_exception(e)
+                ok = False
+            else:
+                future.set_result(response)
+                ok = response.status_code == HTTPStatus.OK
+
+            with self._cond:
+                self._in_flight -= 1
+                self._stats["completed" if ok else "failed"] += 1
+
+    def metrics(self):
+        with self._cond:
+            started = max(self._stats["submitted"] - self._queued, 1)
+            return {
+                "in_flight": self._in_flight,
+                "queued": self._queued,
+                "sessions_waiting": len(self._queues),
+                "submitted": self._stats["submitted"],
+                "completed": self._stats["completed"],
+                "failed": self._stats["failed"],
+                "rejected": self._stats["rejected"],
+                "retries": self._stats["retries"],
+                "mean_queue_wait_ms": self._stats["total_wait"] / started * 1000,
+            }
+
+
+def load_llm_backend(backend=None):
+    """MINGYU_LLM_BACKEND (dashscope | stub), MINGYU_LLM_STUB_LATENCY_MS / _JITTER_MS / _THROTTLE_RATE"""
+    backend = backend or os.getenv('MINGYU_LLM_BACKEND', DashScopeBackend.name)
+    if backend == DashScopeBackend.name:
+        return DashScopeBackend()
+    if backend == StubLLMBackend.name:
+        return StubLLMBackend(
+            latency_ms=float(os.getenv('MINGYU_LLM_STUB_LATENCY_MS', 200)),
+            jitter_ms=float(os.getenv('MINGYU_LLM_STUB_JITTER_MS', 0)),
+            throttle_rate=float(os.getenv('MINGYU_LLM_STUB_THROTTLE_RATE', 0)),
+        )
+    raise ValueError(f"Unknown LLM backend: {backend}")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_llm_scheduler():
+    """
+    Process-wide LLMScheduler shared by all Streamlit sessions.
+    Tunables: MINGYU_LLM_MAX_IN_FLIGHT, MINGYU_LLM_MAX_QUEUE, MINGYU_LLM_MAX_RETRIES
+    """
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = LLMScheduler(
+                load_llm_backend(),
+                max_in_flight=int(os.getenv('MINGYU_LLM_MAX_IN_FLIGHT', 4)),
+                max_queue=int(os.getenv('MINGYU_LLM_MAX_QUEUE', 32)),
+                max_retries=int(os.getenv('MINGYU_LLM_MAX_RETRIES', 3)),
+            )
+    return _scheduler
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline throughput test of the LLM scheduler against the stub backend")
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--sessions', type=int, default=10)
+    parser.add_argument('--latency-ms', type=float, default=200)
+    parser.add_argument('--throttle-rate', type=float, default=0.0)
+    parser.add_argument('--max-in-flight', type=int, default=4)
+    parser.add_argument('--max-queue', type=int, default=1000)
+    args = parser.parse_args()
+
+    scheduler = LLMScheduler(
+        StubLLMBackend(latency_ms=args.latency_ms, throttle_rate=args.throttle_rate, seed=0),
+        max_in_flight=args.max_in_flight, max_queue=args.max_queue, base_delay=0.05,
+    )
+    start = time.perf_counter()
+    futures = []
+    for i in range(args.requests):
+        try:
+            futures.append(scheduler.submit(f"prompt {i}", session_id=i % args.sessions))
+        except QueueFullError:
+            pass
+    for future in futures:
+        future.result()
+    elapsed = time.perf_counter() - start
+    scheduler.close()
+
+    print(f"⏱ {len(futures)} 个请求耗时 {elapsed:.2f}s，吞吐 {len(futures) / elapsed:.1f} req/s")
+    print(f"📊 {scheduler.metrics()}")
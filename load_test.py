@@ -0,0 +1,332 @@
+import os
+import re
+import time
+import json
+import random
+import argparse
+import threading
+from core_logic import GENERATION_ERROR_PREFIXES
+from encoders import get_encoder_service
+from llm_scheduler import get_llm_scheduler
+from index_store import resolve_current
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_FILE = os.path.join(BASE_DIR, 'app.py')
+
+DEFAULT_QUERIES = [
+    "假如张居正支持万历皇帝彻底清算冯保",
+    "假如于谦没有被杀",
+    "假如戚继光率军北上抗击俺答",
+    "假如海瑞出任内阁首辅",
+    "假如崇祯皇帝南迁",
+]
+
+# Rendered texts that mean a stage failed, rather than a normal (possibly audited-as-warning) result
+STAGE_FAILURE_MARKER = "阶段失败"
+
+# share_runtime_across_sessions() patches AppTest internals; this is the oldest streamlit it was checked against
+MIN_STREAMLIT_VERSION = (1, 66)
+APP_TEST_INTERNALS = ('Runtime', 'ScriptCache', 'MediaFileManager', 'MemoryMediaFileStorage',
+                      'DataframeSourceManager', 'MemoryCacheStorageManager', 'BidiComponentManager')
+
+
+def rss_bytes():
+    """Current resident set size of this process (Linux /proc; falls back to peak RSS elsewhere)"""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    import resource
+    import sys
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * q / 100.0
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+
+def summarize(requests):
+    """Per request kind: count, error rate and latency percentiles (ms)"""
+    summary = {}
+    for kind in sorted({r['kind'] for r in requests}):
+        rows = [r for r in requests if r['kind'] == kind]
+        latencies = [r['latency_ms'] for r in rows]
+        errors = [r for r in rows if r['error']]
+        summary[kind] = {
+            "count": len(rows),
+            "errors": len(errors),
+            "error_rate": len(errors) / len(rows),
+            "p50_ms": percentile(latencies, 50),
+            "p90_ms": percentile(latencies, 90),
+            "p95_ms": percentile(latencies, 95),
+            "p99_ms": percentile(latencies, 99),
+            "max_ms": max(latencies),
+        }
+    return summary
+
+
+def window_mean(before, after, mean_key, count_key):
+    """Mean of a running-average metric over the measured window only (excludes the warm-up)"""
+    count = after[count_key] - before[count_key]
+    if count <= 0:
+        return None
+    return (after[mean_key] * after[count_key] - before[mean_key] * before[count_key]) / count
+
+
+def configure_stubs(args):
+    """Point the app's encoder, LLM and CBDB at local stubs before the first script run creates the singletons"""
+    os.environ['MINGYU_ENCODER'] = 'hash'
+    os.environ['MINGYU_ENCODER_STUB_LATENCY_MS'] = str(args.encoder_latency_ms)
+    os.environ['MINGYU_LLM_BACKEND'] = 'stub'
+    os.environ['MINGYU_LLM_STUB_LATENCY_MS'] = str(args.llm_latency_ms)
+    os.environ['MINGYU_LLM_STUB_JITTER_MS'] = str(args.llm_jitter_ms)
+    os.environ['MINGYU_LLM_STUB_THROTTLE_RATE'] = str(args.llm_throttle_rate)
+    os.environ['MINGYU_CBDB_BACKEND'] = 'stub'
+    os.environ['MINGYU_CBDB_STUB_LATENCY_MS'] = str(args.cbdb_latency_ms)
+
+
+def check_streamlit_internals():
+    """Fail early, with the reason, when the installed streamlit lacks the AppTest internals we patch"""
+    import streamlit
+    from streamlit.runtime import Runtime
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    version = tuple(int(part) for part in re.findall(r'\d+', streamlit.__version__)[:2])
+    if version < MIN_STREAMLIT_VERSION:
+        raise RuntimeError(f"load_test.py needs streamlit>={'.'.join(map(str, MIN_STREAMLIT_VERSION))}, "
+                           f"found {streamlit.__version__}")
+    missing = [f"app_test.{name}" for name in APP_TEST_INTERNALS if not hasattr(app_test, name)]
+    if not hasattr(local_script_runner, 'ScriptCache'):
+        missing.append("local_script_runner.ScriptCache")
+    if not hasattr(Runtime, '_instance'):
+        missing.append("Runtime._instance")
+    if missing:
+        raise RuntimeError(f"streamlit {streamlit.__version__} changed the AppTest internals that "
+                           f"share_runtime_across_sessions() patches; missing: {', '.join(missing)}")
+
+
+def share_runtime_across_sessions():
+    """
+    AppTest installs a mock Runtime in the global `Runtime._instance` for each run and clears it when
+    the run ends, so concurrent runs break each other. Install one mock runtime shared by every
+    session, as a real server has one Runtime, and let AppTest assign to a stand-in class instead.
+    Likewise share one ScriptCache: AppTest recompiles the script on every run (a real server compiles
+    it once), and concurrent ast.parse calls are not thread-safe on some CPython versions.
+    """
+    check_streamlit_internals()
+    from unittest.mock import MagicMock
+    from streamlit.runtime import Runtime
+    from streamlit.testing.v1 import app_test, local_script_runner
+
+    if Runtime._instance is not None:
+        return
+    runtime = MagicMock(spec=Runtime)
+    runtime.media_file_mgr = app_test.MediaFileManager(app_test.MemoryMediaFileStorage("/mock/media"))
+    runtime.dataframe_source_mgr = app_test.DataframeSourceManager()
+    runtime.cache_storage_manager = app_test.MemoryCacheStorageManager()
+    registry = app_test.BidiComponentManager()
+    registry.discover_and_register_components(start_file_watching=False)
+    runtime.bidi_component_registry = registry
+    Runtime._instance = runtime
+    app_test.Runtime = type("Runtime", (), {"_instance": None})
+
+    script_cache = app_test.ScriptCache()
+    app_test.ScriptCache = local_script_runner.ScriptCache = lambda: script_cache
+
+
+class SimulatedSession:
+    """
+    One browser session driving app.py through streamlit.testing's AppTest:
+    page load -> submit a hypothesis -> `reruns` alpha-slider changes, with think time in between.
+    Every script run is one measured request. AppTest runs the real script in-process, so all
+    sessions share the process-wide encoder / LLM scheduler / index singletons like a real server;
+    the websocket and browser rendering layers are not exercised.
+    """
+    def __init__(self, session_no, app_file, query, reruns=2, think_ms=0, timeout=120):
+        self.session_no = session_no
+        self.app_file = app_file
+        self.query = query
+        self.reruns = reruns
+        self.think = think_ms / 1000.0
+        self.timeout = timeout
+        self.requests = []
+        self.app = None
+
+    def _classify(self):
+        if self.app.exception:
+            return f"exception: {self.app.exception[0].value}"
+        for element in self.app.error:
+            if STAGE_FAILURE_MARKER in element.value:
+                return element.value
+        for element in self.app.markdown:
+            if element.value.startswith(GENERATION_ERROR_PREFIXES):
+                return element.value
+        return None
+
+    def _request(self, kind, action):
+        start = time.perf_counter()
+        try:
+            action()
+            error = self._classify()
+        except Exception as e:
+            # Typically the AppTest timeout: the run did not finish within `timeout` seconds
+            error = f"{type(e).__name__}: {e}"
+        self.requests.append({
+            "session": self.session_no,
+            "kind": kind,
+            "latency_ms": (time.perf_counter() - start) * 1000,
+            "error": error,
+        })
+        time.sleep(self.think)
+
+    def run(self):
+        from streamlit.testing.v1 import AppTest
+        self.app = AppTest.from_file(self.app_file, default_timeout=self.timeout)
+        self._request("page_load", self.app.run)
+        if self.requests[-1]["error"]:
+            return
+
+        def submit():
+            self.app.text_input[0].input(self.query)
+            self.app.button[0].click()
+            self.app.run()
+        self._request("generate", submit)
+
+        for i in range(self.reruns):
+            alpha = round(0.1 + 0.8 * ((self.session_no + i + 1) % 9) / 8, 2)
+            self._request("alpha_rerun", lambda: self.app.slider[0].set_value(alpha).run())
+
+
+def run_load_test(app_file=APP_FILE, sessions=50, ramp_s=5.0, reruns=2, think_ms=500, timeout=120,
+                  queries=DEFAULT_QUERIES, seed=0):
+    share_runtime_across_sessions()
+
+    # Warm-up session: module imports, index load and singleton start-up are one-off costs
+    warmup = SimulatedSession(-1, app_file, queries[0], reruns=0, timeout=timeout)
+    warmup.run()
+    if any(r["error"] for r in warmup.requests):
+        raise RuntimeError(f"Warm-up session failed: {warmup.requests}")
+
+    encoder_before = get_encoder_service().metrics()
+    llm_before = get_llm_scheduler().metrics()
+    rss_before = rss_bytes()
+
+    peak = {"rss": rss_before}
+    stop_sampling = threading.Event()
+
+    def sample_rss():
+        while not stop_sampling.wait(0.1):
+            peak["rss"] = max(peak["rss"], rss_bytes())
+    sampler = threading.Thread(target=sample_rss, daemon=True)
+    sampler.start()
+
+    rng = random.Random(seed)
+    simulated = [SimulatedSession(i, app_file, rng.choice(queries), reruns=reruns, think_ms=think_ms, timeout=timeout)
+                 for i in range(sessions)]
+
+    def start_session(session, delay):
+        time.sleep(delay)
+        session.run()
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=start_session, args=(s, ramp_s * i / max(sessions, 1)), name=f"session-{i}")
+               for i, s in enumerate(simulated)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    # Sessions (and their session_state) are still referenced here, so RSS reflects all of them alive
+    rss_after = rss_bytes()
+    stop_sampling.set()
+    sampler.join()
+
+    encoder_after = get_encoder_service().metrics()
+    llm_after = get_llm_scheduler().metrics()
+    requests = [r for s in simulated for r in s.requests]
+    return {
+        "sessions": sessions,
+        "elapsed_s": elapsed,
+        "requests_per_s": len(requests) / elapsed,
+        "latency": summarize(requests),
+        "queueing": {
+            "encoder_mean_wait_ms": window_mean(encoder_before, encoder_after, "mean_wait_ms", "items"),
+            "encoder_mean_batch_size": encoder_after["mean_batch_size"],
+            "llm_mean_queue_wait_ms": window_mean(llm_before, llm_after, "mean_queue_wait_ms", "submitted"),
+            "llm_retries": llm_after["retries"] - llm_before["retries"],
+            "llm_rejected": llm_after["rejected"] - llm_before["rejected"],
+        },
+        "memory": {
+            "rss_before_mb": rss_before / 2**20,
+            "rss_after_mb": rss_after / 2**20,
+            "rss_peak_mb": peak["rss"] / 2**20,
+            "rss_per_session_mb": (rss_after - rss_before) / 2**20 / max(sessions, 1),
+        },
+        "requests": requests,
+    }
+
+
+def print_report(report):
+    print(f"\n👥 {report['sessions']} 个并发会话, 用时 {report['elapsed_s']:.1f}s, {report['requests_per_s']:.2f} req/s")
+    print(f"   {'request':<12} {'count':>6} {'err%':>6} {'p50':>9} {'p90':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)")
+    for kind, row in report['latency'].items():
+        print(f"   {kind:<12} {row['count']:>6} {row['error_rate']:>6.1%} {row['p50_ms']:>9.0f} {row['p90_ms']:>9.0f} "
+              f"{row['p95_ms']:>9.0f} {row['p99_ms']:>9.0f} {row['max_ms']:>9.0f}")
+    print("⏳ 排队延迟 (Queueing):")
+    for key, value in report['queueing'].items():
+        print(f"   {key:<26} {value if value is None or isinstance(value, int) else round(value, 2)}")
+    memory = report['memory']
+    print(f"🧠 RSS: {memory['rss_before_mb']:.0f} MB -> {memory['rss_after_mb']:.0f} MB "
+          f"(峰值 {memory['rss_peak_mb']:.0f} MB), 每会话约 {memory['rss_per_session_mb']:.2f} MB")
+    errors = [r for r in report['requests'] if r['error']]
+    for r in errors[:5]:
+        print(f"   ❌ session {r['session']} {r['kind']}: {r['error'][:120]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="用 N 个并发模拟会话压测 app.py (编码/LLM/CBDB 均为本地桩)")
+    parser.add_argument('--sessions', type=int, default=50)
+    parser.add_argument('--ramp-s', type=float, default=5.0, help="在多少秒内陆续启动全部会话")
+    parser.add_argument('--reruns', type=int, default=2, help="每个会话生成后再调整几次 Alpha 滑块")
+    parser.add_argument('--think-ms', type=float, default=500, help="同一会话两次操作之间的间隔")
+    parser.add_argument('--timeout', type=float, default=120, help="单次脚本运行的超时 (秒)，超时计为错误")
+    parser.add_argument('--encoder-latency-ms', type=float, default=20, help="桩编码器每次前向计算的耗时")
+    parser.add_argument('--llm-latency-ms', type=float, default=2000)
+    parser.add_argument('--llm-jitter-ms', type=float, default=1000)
+    parser.add_argument('--llm-throttle-rate', type=float, default=0.0, help="桩 LLM 返回限流错误的比例")
+    parser.add_argument('--cbdb-latency-ms', type=float, default=800)
+    parser.add_argument('--queries', default=None, help="每行一个假设的文本文件，默认使用内置示例")
+    parser.add_argument('--app', default=APP_FILE)
+    parser.add_argument('--json', default=None, help="把完整结果 (含每个请求) 写入该 JSON 文件")
+    args = parser.parse_args()
+
+    queries = DEFAULT_QUERIES
+    if args.queries:
+        with open(args.queries, encoding='utf-8') as f:
+            queries = [line.strip() for line in f if line.strip()]
+
+    if resolve_current(os.path.join(os.path.dirname(os.path.abspath(args.app)), 'ming_vectors.pkl')) is None:
+        raise SystemExit("❌ 未找到索引，请先运行 build_index.py (无模型时可用 MINGYU_ENCODER=hash)")
+
+    configure_stubs(args)
+    report = run_load_test(app_file=args.app, sessions=args.sessions, ramp_s=args.ramp_s, reruns=args.reruns,
+                           think_ms=args.think_ms, timeout=args.timeout, queries=queries)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,92 @@
+import time
+import itertools
+import numpy as np
+from hierarchical_index import sample_queries, flat_top_k
+
+
+def fit_projection(embeddings, dim=128, whiten=False):
+    """
+    Corpus-specific PCA projection to `dim` dimensions, fitted on the index embeddings.
+    whiten=True also rescales each component by 1/sqrt(eigenvalue) (BERT-whitening style),
+    so reduced vectors are compared by cosine in the whitened space.
+    """
+    dim = min(dim, embeddings.shape[1])
+    mean = embeddings.mean(axis=0, dtype=np.float64)
+    centered = embeddings - mean
+    cov = centered.T @ centered / len(embeddings)
+    eigvals, eigvecs = np.linalg.eigh(cov)
+    order = np.argsort(eigvals)[::-1][:dim]
+    components = eigvecs[:, order].T
+    if whiten:
+        components = components / np.sqrt(np.maximum(eigvals[order], 1e-12))[:, None]
+    return {
+        "mean": mean.astype(np.float32),
+        "components": np.ascontiguousarray(components, dtype=np.float32),
+        "whiten": whiten,
+        "explained_variance": float(eigvals[order].sum() / eigvals.sum()),
+    }
+
+
+def project_corpus(projection, embeddings):
+    reduced = (embeddings - projection["mean"]) @ projection["components"].T
+    if projection["whiten"]:
+        reduced /= np.linalg.norm(reduced, axis=1, keepdims=True)
+    return np.ascontiguousarray(reduced, dtype=np.float32)
+
+
+def project_query(projection, query_vec):
+    # Plain PCA keeps the query uncentered: q.(x - mean) ranks chunks exactly like q.x, since q.mean
+    # is the same for every chunk. Whitening changes the metric, so both sides are centered there.
+    q = np.ravel(query_vec)
+    if projection["whiten"]:
+        q = q - projection["mean"]
+    return projection["components"] @ q
+
+
+def reduced_search(projection, reduced_embeddings, embeddings, query_vec, top_k=3, candidates=100):
+    """
+    Two-pass search: take the best `candidates` chunks in the reduced space, then re-score them
+    with the full vectors. Returns (indices, scores) by exact score, best first.
+    """
+    q = np.ravel(query_vec)
+    coarse = reduced_embeddings @ project_query(projection, q)
+    candidates = min(max(candidates, top_k), len(coarse))
+    shortlist = np.argpartition(-coarse, candidates - 1)[:candidates]
+    scores = embeddings[shortlist] @ q
+    order = np.argsort(-scores)[:top_k]
+    return shortlist[order], scores[order]
+
+
+def benchmark_reduced(embeddings, top_k=10, dim_options=(64, 128, 256), whiten_options=(False, True),
+                      candidate_options=(20, 50, 100, 200), n_queries=200, noise=0.8, seed=0, queries=None):
+    """
+    Latency and recall@k of reduced-dimension search with full-dimension re-scoring vs. flat search.
+    `queries` are real encoded query vectors; without them, noisy corpus chunks stand in.
+    """
+    if queries is None:
+        queries = sample_queries(embeddings, n_queries=n_queries, noise=noise, seed=seed)
+    truth, flat_ms = flat_top_k(embeddings, queries, top_k=top_k)
+
+    rows = [{"mode": "flat", "dim": embeddings.shape[1], "whiten": None, "candidates": len(embeddings),
+             "latency_ms": flat_ms, "recall": 1.0, "explained_variance": 1.0}]
+    for dim, whiten in itertools.product(dim_options, whiten_options):
+        if dim > embeddings.shape[1]:
+            continue
+        projection = fit_projection(embeddings, dim=dim, whiten=whiten)
+        reduced = project_corpus(projection, embeddings)
+        for candidates in candidate_options:
+            hits = 0
+            start = time.perf_counter()
+            for q, expected in zip(queries, truth):
+                found, _ = reduced_search(projection, reduced, embeddings, q, top_k=top_k, candidates=candidates)
+                hits += len(expected & set(found))
+            rows.append({
+                "mode": "reduced",
+                "dim": dim,
+                "whiten": whiten,
+                "candidates": candidates,
+                "latency_ms": (time.perf_counter() - start) / len(queries) * 1000,
+                "recall": hits / (len(queries) * top_k),
+                "explained_variance": projection["explained_variance"],
+            })
+    return rows
@@ -0,0 +1,108 @@
+import unittest
+import sys
+import os
+import json
+import tempfile
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoders import HashingEncoderBackend
+from llm_scheduler import LLMScheduler, StubLLMBackend
+from index_store import IndexSnapshot, publish_index, resolve_current
+from chunk_table import ChunkTable
+from core_logic import ContextPacker
+from batch_runner import BatchRunner, JsonlSink, read_tasks
+
+TEXTS = ["张居正推行一条鞭法", "海瑞上疏批评嘉靖", "戚继光抗击倭寇", "内阁票拟与司礼监批红", "万历三大征"]
+
+class TestBatchRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.encoder = HashingEncoderBackend(dim=64)
+        records = [{"id": str(i), "name": f"n{i}", "category": "人物", "text": t} for i, t in enumerate(TEXTS)]
+        vector_file = os.path.join(self.tmp.name, 'ming_vectors.pkl')
+        publish_index({'columns': ChunkTable.from_records(records).to_columns(),
+                       'embeddings': self.encoder.encode(TEXTS)}, vector_file)
+        self.snapshot = IndexSnapshot.load(resolve_current(vector_file))
+
+        self.input_file = os.path.join(self.tmp.name, 'hypotheses.jsonl')
+        with open(self.input_file, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({"query": "假如张居正没有去世"}, ensure_ascii=False) + "\n")
+            f.write(json.dumps({"hypothesis": "假如戚继光北上", "alpha": 0.5}, ensure_ascii=False) + "\n")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def make_runner(self):
+        scheduler = LLMScheduler(StubLLMBackend(latency_ms=0), max_in_flight=2)
+        return BatchRunner(self.snapshot, self.encoder, scheduler, packer=ContextPacker(), max_in_flight=2), scheduler
+
+    def test_read_tasks_expands_alphas(self):
+        tasks = read_tasks(self.input_file, [0.2, 0.8])
+        self.assertEqual([(t['query'], t['alpha']) for t in tasks],
+                         [("假如张居正没有去世", 0.2), ("假如张居正没有去世", 0.8), ("假如戚继光北上", 0.5)])
+        self.assertEqual(len({t['key'] for t in tasks}), 3)
+
+    def test_search_matches_single_query_path(self):
+        runner, scheduler = self.make_runner()
+        scheduler.close()
+        query_vecs = self.encoder.encode(["戚继光抗倭", "内阁票拟"])
+        results = runner.search(query_vecs, [0.3, 0.3], top_k=3)
+        for query_vec, (anchor, nearby) in zip(query_vecs, results):
+            self.assertEqual(anchor.index, int((self.snapshot.embeddings @ query_vec).argmax()))
+            self.assertNotIn(anchor.index, [r.index for r in nearby])
+            self.assertEqual([r.score for r in nearby], sorted([r.score for r in nearby], reverse=True))
+
+    def test_run_and_resume(self):
+        output = os.path.join(self.tmp.name, 'out.jsonl')
+        sink = JsonlSink(output)
+        tasks = read_tasks(self.input_file, [0.2, 0.8])
+
+        runner, scheduler = self.make_runner()
+        sink.write(runner.run_batch(tasks[:2]))
+        scheduler.close()
+        self.assertEqual(runner.timer.report()['generation']['items'], 2)
+
+        # Simulate a crash mid-write: the truncated line is ignored and that task re-runs
+        with open(output, 'a', encoding='utf-8') as f:
+            f.write('{"key": "trunc')
+        pending = [t for t in tasks if t['key'] not in sink.done_keys()]
+        self.assertEqual(pending, tasks[2:])
+
+        # The next write drops the partial line instead of appending onto it
+        runner, scheduler = self.make_runner()
+        sink.write(runner.run_batch(pending))
+        scheduler.close()
+        self.assertEqual(sink.done_keys(), {t['key'] for t in tasks})
+        with open(output, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+        self.assertEqual([json.loads(line)['key'] for line in lines], [t['key'] for t in tasks])
+
+        with open(output, encoding='utf-8') as f:
+            record = json.loads(f.readline())
+        self.assertTrue(record['generated'].startswith("【模拟生成】"))
+        self.assertIn(record['anchor_id'], [str(i) for i in range(len(TEXTS))])
+        self.assertLessEqual(record['prompt_tokens_after'], record['prompt_tokens_before'])
+        self.assertIn('audit_passed', record)
+
+    def test_failed_generations_are_retried_on_resume(self):
+        output = os.path.join(self.tmp.name, 'out.jsonl')
+        sink = JsonlSink(output)
+        tasks = read_tasks(self.input_file, [0.3])
+
+        # Provider outage: every call is throttled and retries are exhausted
+        scheduler = LLMScheduler(StubLLMBackend(latency_ms=0, throttle_rate=1.0), max_in_flight=2, max_retries=0)
+        records = BatchRunner(self.snapshot, self.encoder, scheduler).run_batch(tasks)
+        scheduler.close()
+        sink.write(records)
+        self.assertEqual({r['status'] for r in records}, {"error"})
+        self.assertEqual(sink.done_keys(), set())
+
+        runner, scheduler = self.make_runner()
+        sink.write(runner.run_batch([t for t in tasks if t['key'] not in sink.done_keys()]))
+        scheduler.close()
+        self.assertEqual(sink.done_keys(), {t['key'] for t in tasks})
+
+if __name__ == '__main__':
+    unittest.main()
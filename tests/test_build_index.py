@@ -0,0 +1,53 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from build_index import build_knn_graph, split_chapters, is_chapter_heading, read_and_chunk_files
+
+class TestBuildIndex(unittest.TestCase):
+
+    def test_build_knn_graph_matches_brute_force(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(50, 8)).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        # Small block size forces several blocks
+        indices, scores = build_knn_graph(embeddings, k=5, block_size=7)
+
+        sims = embeddings @ embeddings.T
+        np.fill_diagonal(sims, -np.inf)
+        expected = np.argsort(-sims, axis=1)[:, :5]
+        np.testing.assert_array_equal(indices, expected)
+        np.testing.assert_array_almost_equal(scores, np.take_along_axis(sims, expected, axis=1))
+        self.assertFalse(np.any(indices == np.arange(50)[:, None]))
+
+    def test_split_chapters(self):
+        content = "人物: 张居正\n    太祖本纪(一)\n    明太祖，讳元璋。\n    (二)\n    洪武元年。"
+        sections = split_chapters(content, "明史")
+        self.assertEqual([c for c, _ in sections], ["明史", "太祖本纪(一)", "太祖本纪(二)"])
+        self.assertIn("讳元璋", sections[1][1])
+
+    def test_wiki_lines_are_not_headings(self):
+        for line in ["（1402年）", "瓦剌（四卫拉特）", "镶红旗营妃嫔墓", "参见", "人物: 张居正"]:
+            self.assertFalse(is_chapter_heading(line), line)
+        for line in ["郭子兴传", "鲁王朱檀、朱以海传", "(三)"]:
+            self.assertTrue(is_chapter_heading(line), line)
+        content = "人物: 张居正\n    生平\n    张居正，字叔大。\n    郭子兴传"
+        self.assertEqual(split_chapters(content, "张居正"), [("张居正", content)])
+
+    def test_chunks_do_not_straddle_chapters(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, "【明史·上】.txt"), "w", encoding="utf-8") as f:
+                f.write("太祖本纪(一)\n明太祖，讳元璋。\n(二)\n洪武元年。\n郭子兴传\n郭子兴，定远人。")
+            chunks = read_and_chunk_files(tmp)
+        self.assertEqual([c["chapter"] for c in chunks], ["太祖本纪(一)", "太祖本纪(二)", "郭子兴传"])
+        self.assertIn("讳元璋", chunks[0]["text"])
+        self.assertNotIn("洪武", chunks[0]["text"])
+        self.assertEqual(len({c["id"] for c in chunks}), 3)
+
+if __name__ == '__main__':
+    unittest.main()
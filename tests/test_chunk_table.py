@@ -0,0 +1,47 @@
+import unittest
+import sys
+import os
+import pickle
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chunk_table import ChunkTable, SearchResult
+
+RECORDS = [
+    {"id": "张居正_0", "name": "张居正", "category": "人物", "text": "张居正推行一条鞭法。"},
+    {"id": "张居正_last", "name": "张居正", "category": "人物", "text": "考成法。"},
+    {"id": "【明史·上】_2", "name": "【明史·上】", "category": "典籍", "chapter": "太祖本纪(一)", "text": "𠀀字。"},
+]
+
+class TestChunkTable(unittest.TestCase):
+
+    def test_roundtrip_and_row_access(self):
+        table = ChunkTable(pickle.loads(pickle.dumps(ChunkTable.from_records(RECORDS).to_columns())))
+        self.assertEqual(len(table), 3)
+        self.assertEqual(table[0]['text'], "张居正推行一条鞭法。")
+        self.assertEqual(table[2].text, "𠀀字。")
+        self.assertEqual(table[1].get('chapter'), "张居正")
+        self.assertEqual(table[2]['chapter'], "太祖本纪(一)")
+        self.assertIsNone(table[0].get('vector'))
+        with self.assertRaises(KeyError):
+            table[0]['missing']
+        self.assertEqual([r.id for r in table], [r['id'] for r in RECORDS])
+
+    def test_interned_columns(self):
+        table = ChunkTable.from_records(RECORDS)
+        self.assertEqual(table.names.values, ["张居正", "【明史·上】"])
+        np.testing.assert_array_equal(table.entry_ids, [0, 0, 1])
+        self.assertEqual(table.categories.values, ["人物", "典籍"])
+
+    def test_search_result_view(self):
+        table = ChunkTable.from_records(RECORDS)
+        embeddings = np.eye(3, dtype=np.float32)
+        result = SearchResult(table, embeddings, np.int64(1), 0.5)
+        self.assertFalse(hasattr(result, '__dict__'))
+        self.assertEqual(result['index'], 1)
+        self.assertEqual(result['data']['id'], "张居正_last")
+        np.testing.assert_array_equal(result['vector'], [0, 1, 0])
+
+if __name__ == '__main__':
+    unittest.main()
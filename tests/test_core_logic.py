@@ -1,8 +1,11 @@
 import unittest
 import sys
 import os
+import gc
+import threading
+import tempfile
 import numpy as np
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 
 # Mock sentence_transformers and streamlit before importing core_logic
 sys.modules['sentence_transformers'] = MagicMock()
@@ -26,7 +29,16 @@ sys.modules['jieba'].cut.side_effect = jieba_cut_mock
 # Add parent directory to path to import core_logic
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-from core_logic import ContextAlignmentLayer, FictionDiffusionLayer, ContentAuditor
+from core_logic import (
+    HistoryEmbeddingLayer, ContextAlignmentLayer, FictionDiffusionLayer, ContentAuditor,
+    QwenGenerationLayer, ExternalKnowledgeLayer, StageCache, CachedPipeline, ContextPacker, estimate_tokens,
+    truncate_to_tokens
+)
+from llm_scheduler import LLMScheduler, StubLLMBackend
+from reduced_index import fit_projection, project_corpus
+from encoders import HashingEncoderBackend
+from index_store import IndexManager, publish_index
+from chunk_table import ChunkTable
 
 class MockEmbeddingLayer:
     def search(self, vec, top_k=3):
@@ -36,6 +48,24 @@ class MockEmbeddingLayer:
             {"data": {"id": "2", "text": "test2", "name": "test2"}, "score": 0.8}
         ]
 
+def make_embedding_layer(embeddings, knn_indices=None, knn_scores=None):
+    # Bypass _load_resources (Streamlit session state) and inject the index directly
+    layer = HistoryEmbeddingLayer.__new__(HistoryEmbeddingLayer)
+    layer.model = None
+    layer.version = None
+    layer.db_embeddings = embeddings
+    layer.db_data = [{"id": str(i), "text": f"text{i}", "name": f"name{i}", "category": "人物"} for i in range(len(embeddings))]
+    layer.knn_indices = knn_indices
+    layer.knn_scores = knn_scores
+    layer.search_mode = "flat"
+    layer.top_entries = 5
+    layer.top_chapters = None
+    layer.hierarchy = None
+    layer.rerank_candidates = 100
+    layer.projection = None
+    layer.reduced_embeddings = None
+    return layer
+
 class TestCoreLogic(unittest.TestCase):
 
     def test_context_alignment_layer(self):
@@ -67,6 +97,205 @@ class TestCoreLogic(unittest.TestCase):
         np.testing.assert_array_almost_equal(gen_vec, expected)
         self.assertEqual(len(results), 2)
 
+    def test_graph_search(self):
+        # Chain graph 0->1->2: two hops from chunk 0 reach only chunks 0..2
+        angles = np.linspace(0, np.pi / 2, 5)
+        embeddings = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        knn_indices = np.array([[1], [2], [1], [2], [3]])
+        knn_scores = np.ones((5, 1))
+        layer = make_embedding_layer(embeddings, knn_indices, knn_scores)
+
+        self.assertEqual([r['index'] for r in layer.neighbors(2)], [1])
+
+        query = np.array([0.0, 1.0])
+        results = layer.graph_search(query, [0], top_k=5, hops=2)
+        self.assertEqual([r['index'] for r in results], [2, 1, 0])
+
+        # Without a graph it falls back to the full scan
+        layer = make_embedding_layer(embeddings)
+        results = layer.graph_search(query, [0], top_k=1)
+        self.assertEqual(results[0]['index'], 4)
+
+    def test_reduced_search_mode(self):
+        rng = np.random.default_rng(0)
+        embeddings = rng.normal(size=(50, 16))
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        layer = make_embedding_layer(embeddings)
+        layer.search_mode = "reduced"
+        query = embeddings[3:4]
+
+        # Index built without --reduce-dim: falls back to the flat scan
+        flat = [r['index'] for r in layer.search(query, top_k=3)]
+        layer.projection = fit_projection(embeddings, dim=4)
+        layer.reduced_embeddings = project_corpus(layer.projection, embeddings)
+        results = layer.search(query, top_k=3)
+        # Shortlisting every chunk makes the re-scored result identical to the flat scan
+        self.assertEqual([r['index'] for r in layer.reduced_search(query, top_k=3, candidates=50)], flat)
+        self.assertEqual(results[0]['index'], 3)
+
+    def test_stage_cache_eviction(self):
+        cache = StageCache(max_entries=2)
+        calls = []
+        for key in ["a", "b", "a", "c", "b"]:
+            cache.get_or_compute(key, lambda: calls.append(key) or key)
+        # "b" was evicted when "c" arrived ("a" had been used more recently)
+        self.assertEqual(calls, ["a", "b", "c", "b"])
+        self.assertEqual(cache.hits, 1)
+        self.assertEqual(len(cache), 2)
+
+        cache.get_or_compute("x", lambda: "failed", should_cache=lambda v: v != "failed")
+        self.assertEqual(cache.get_or_compute("x", lambda: "ok"), "ok")
+
+    def test_stage_cache_concurrent_get_or_compute(self):
+        def hammer(cache, keys, threads=8):
+            barrier = threading.Barrier(threads)
+            wrong = []
+            def worker(offset):
+                barrier.wait()
+                for i in range(len(keys) * 4):
+                    key = keys[(i + offset) % len(keys)]
+                    value = cache.get_or_compute(key, lambda: key * 2)
+                    if value != key * 2:
+                        wrong.append((key, value))
+            workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+            for w in workers: w.start()
+            for w in workers: w.join()
+            self.assertEqual(wrong, [])
+            return threads * len(keys) * 4
+
+        # Room for every key: nothing is lost and every later lookup is a hit
+        cache = StageCache(max_entries=64)
+        calls = hammer(cache, list(range(32)))
+        self.assertEqual(cache.hits + cache.misses, calls)
+        self.assertEqual(len(cache), 32)
+        misses = cache.misses
+        for key in range(32):
+            self.assertEqual(cache.get_or_compute(key, lambda: None), key * 2)
+        self.assertEqual(cache.misses, misses)
+
+        # More keys than entries: the LRU bound holds and surviving entries are intact
+        cache = StageCache(max_entries=8)
+        hammer(cache, list(range(32)))
+        self.assertEqual(len(cache), 8)
+        for key, value in list(cache._entries.items()):
+            self.assertEqual(value, key * 2)
+
+    def test_cached_pipeline_alpha_change_skips_upstream(self):
+        angles = np.linspace(0, np.pi / 2, 5)
+        embeddings = np.stack([np.cos(angles), np.sin(angles)], axis=1)
+        emb = make_embedding_layer(embeddings)
+        emb.encode = MagicMock(return_value=np.array([[0.0, 1.0]]))
+        gen = MagicMock()
+        gen.build_prompt.side_effect = lambda q, f, n, a: f"{q}|{f}|{a}"
+        gen.generate_from_prompt.side_effect = lambda prompt: "text:" + prompt
+        pipeline = CachedPipeline(emb, FictionDiffusionLayer(emb), gen)
+
+        for alpha in [0.3, 0.5, 0.3]:
+            fact = pipeline.anchor("q")
+            _, nearby = pipeline.diffusion("q", alpha)
+            pipeline.generation("q", fact['data']['text'], [r['data']['text'] for r in nearby], alpha)
+
+        self.assertEqual(emb.encode.call_count, 1)
+        self.assertEqual(pipeline.stats()['diffusion']['misses'], 2)
+        self.assertEqual(gen.generate_from_prompt.call_count, 2)
+
+    def test_cached_pipeline_rebind_drops_stale_index_stages(self):
+        embeddings = np.eye(3)
+        emb = make_embedding_layer(embeddings)
+        emb.version = "v1"
+        emb.encode = MagicMock(return_value=np.array([[1.0, 0.0, 0.0]]))
+        pipeline = CachedPipeline(emb, FictionDiffusionLayer(emb), MagicMock())
+        pipeline.anchor("q")
+
+        pipeline.bind(emb, FictionDiffusionLayer(emb), MagicMock())
+        self.assertEqual(len(pipeline.caches['anchor']), 1)
+
+        reloaded = make_embedding_layer(embeddings)
+        reloaded.version = "v2"
+        pipeline.bind(reloaded, FictionDiffusionLayer(reloaded), MagicMock())
+        self.assertEqual(len(pipeline.caches['anchor']), 0)
+        self.assertEqual(len(pipeline.caches['query_embedding']), 1)
+
+    def test_cached_pipeline_retries_failed_cbdb_lookup(self):
+        pipeline = CachedPipeline(MockEmbeddingLayer(), MagicMock(), MagicMock())
+        bio = {"name": "张居正", "id": "1"}
+        with patch.object(ExternalKnowledgeLayer, 'get_cbdb_bio', side_effect=[None, bio]) as lookup:
+            self.assertIsNone(pipeline.cbdb("张居正"))
+            self.assertEqual(pipeline.cbdb("张居正"), bio)
+            self.assertEqual(pipeline.cbdb("张居正"), bio)
+        self.assertEqual(lookup.call_count, 2)
+
+    def test_idle_session_does_not_pin_retired_index(self):
+        encoder = HashingEncoderBackend(dim=32)
+        texts = ["张居正推行一条鞭法", "海瑞上疏", "戚继光抗倭", "内阁票拟"]
+        records = [{"id": str(i), "name": f"n{i}", "category": "人物", "text": t} for i, t in enumerate(texts)]
+        payload = {'columns': ChunkTable.from_records(records).to_columns(), 'embeddings': encoder.encode(texts)}
+        with tempfile.TemporaryDirectory() as tmp:
+            vector_file = os.path.join(tmp, 'ming_vectors.pkl')
+            publish_index(payload, vector_file)
+            manager = IndexManager(vector_file)
+            with patch('core_logic.get_index_manager', return_value=manager), \
+                 patch('core_logic.get_encoder_service', return_value=encoder):
+                # One Streamlit run: the pipeline survives in session state, the layers do not
+                layer = HistoryEmbeddingLayer(vector_file)
+                old_version = layer.version
+                pipeline = CachedPipeline(layer, FictionDiffusionLayer(layer), MagicMock())
+                pipeline.anchor("张居正")
+                pipeline.diffusion("张居正", 0.3)
+                pipeline.release()
+                del layer
+                gc.collect()
+
+                publish_index(payload, vector_file)
+                manager.check_for_update()
+                self.assertEqual(manager.status()["refs"], {})
+                self.assertEqual(manager.status()["retired"], [])
+
+                # The next run rebinds to the new version and recomputes the index stages
+                layer = HistoryEmbeddingLayer(vector_file)
+                self.assertNotEqual(layer.version, old_version)
+                pipeline.bind(layer, FictionDiffusionLayer(layer), MagicMock())
+                self.assertEqual(pipeline.anchor("张居正")['data']['id'], "0")
+                self.assertEqual(pipeline.stats()['anchor']['misses'], 1)
+
+    def test_context_packer(self):
+        def item(text, vec):
+            return {"data": {"text": text}, "vector": np.array(vec)}
+
+        fact = item("张居正推行一条鞭法。张居正任内阁首辅。", [1.0, 0.0])
+        nearby = [
+            item("张居正推行一条鞭法。万历皇帝亲政。", [0.8, 0.6]),
+            item("郑和七下西洋。宝船规模宏大。", [0.0, 1.0]),
+        ]
+        packer = ContextPacker(token_budget=30)
+        fact_text, context_texts = packer.pack("张居正改革", np.array([[1.0, 0.0]]), fact, nearby)
+
+        # The anchor keeps its sentences in order; the duplicated sentence is not repeated in the context
+        self.assertEqual(fact_text, "张居正推行一条鞭法。张居正任内阁首辅。")
+        self.assertNotIn("一条鞭法", "".join(context_texts))
+        self.assertIn("万历皇帝亲政。", context_texts)
+        self.assertLessEqual(estimate_tokens(fact_text + "".join(context_texts)), 30)
+
+    def test_context_packer_truncates_oversized_anchor(self):
+        fact = {"data": {"text": "张" * 500 + "。"}, "vector": np.array([1.0, 0.0])}
+        nearby = [{"data": {"text": "张居正任首辅。"}, "vector": np.array([0.8, 0.6])}]
+        fact_text, context_texts = ContextPacker(token_budget=400).pack("张居正", np.array([[1.0, 0.0]]), fact, nearby)
+        self.assertEqual(fact_text, "张" * 400)
+        self.assertEqual(context_texts, [])
+        self.assertEqual(truncate_to_tokens("abcdefgh张", 2), "abcdefgh")
+
+    def test_generation_layer_uses_scheduler(self):
+        scheduler = LLMScheduler(StubLLMBackend(latency_ms=0), max_in_flight=1, max_queue=0)
+        layer = QwenGenerationLayer(scheduler=scheduler, session_id="s1")
+        # max_queue=0 rejects everything: the layer reports the shed load instead of raising
+        self.assertTrue(layer.generate_from_prompt("prompt").startswith("⏳"))
+        scheduler.close()
+
+        scheduler = LLMScheduler(StubLLMBackend(latency_ms=0), max_in_flight=1)
+        layer = QwenGenerationLayer(scheduler=scheduler, session_id="s1")
+        self.assertIn("prompt", layer.generate_from_prompt("prompt"))
+        scheduler.close()
+
     def test_content_auditor(self):
         auditor = ContentAuditor()
         
@@ -0,0 +1,77 @@
+import unittest
+import sys
+import os
+import threading
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from encoders import HashingEncoderBackend, MicroBatchEncoder, parity_check, load_encoder
+
+class CountingBackend(HashingEncoderBackend):
+    def __init__(self):
+        super().__init__(dim=32)
+        self.calls = 0
+
+    def encode(self, texts, batch_size=32):
+        self.calls += 1
+        return super().encode(texts)
+
+class TestEncoders(unittest.TestCase):
+
+    def test_hash_backend_is_deterministic_and_normalized(self):
+        backend = HashingEncoderBackend(dim=64)
+        a = backend.encode(["张居正改革", "土木堡之变"])
+        b = HashingEncoderBackend(dim=64).encode(["张居正改革", "土木堡之变"])
+
+        self.assertEqual(a.shape, (2, 64))
+        self.assertEqual(a.dtype, np.float32)
+        np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_almost_equal(np.linalg.norm(a, axis=1), [1.0, 1.0])
+
+    def test_hash_backend_similar_texts_are_closer(self):
+        backend = HashingEncoderBackend()
+        vecs = backend.encode(["张居正改革", "张居正变法", "郑和下西洋"])
+        self.assertGreater(vecs[0] @ vecs[1], vecs[0] @ vecs[2])
+
+    def test_parity_check(self):
+        texts = ["张居正改革", "郑和下西洋"]
+        report = parity_check(HashingEncoderBackend(), HashingEncoderBackend(), texts)
+        self.assertTrue(report['passed'])
+        self.assertAlmostEqual(report['min_cosine'], 1.0, places=5)
+
+        report = parity_check(HashingEncoderBackend(), HashingEncoderBackend(dim=512), ["锦衣卫"], threshold=1.01)
+        self.assertFalse(report['passed'])
+
+    def test_load_encoder(self):
+        self.assertIsInstance(load_encoder('hash'), HashingEncoderBackend)
+        with self.assertRaises(ValueError):
+            load_encoder('nope')
+
+    def test_micro_batch_encoder_batches_concurrent_requests(self):
+        backend = CountingBackend()
+        service = MicroBatchEncoder(backend, max_batch_size=8, max_wait_ms=50)
+        texts = [f"条目{i}" for i in range(16)]
+        results = [None] * len(texts)
+        barrier = threading.Barrier(len(texts))
+
+        def worker(i):
+            barrier.wait()
+            results[i] = service.encode([texts[i]])
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(texts))]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        service.close()
+
+        expected = HashingEncoderBackend(dim=32).encode(texts)
+        np.testing.assert_array_almost_equal(np.vstack(results), expected)
+        self.assertLess(backend.calls, len(texts))
+
+        metrics = service.metrics()
+        self.assertEqual(metrics['items'], len(texts))
+        self.assertLessEqual(metrics['max_batch_size'], 8)
+        self.assertEqual(metrics['queue_depth'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
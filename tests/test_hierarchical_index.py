@@ -0,0 +1,64 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from hierarchical_index import build_hierarchy, hierarchical_ranges, score_ranges, benchmark_hierarchy
+
+def corpus():
+    # Three entries; entry "b" has two chapters. Each entry lives near its own axis.
+    data, vecs = [], []
+    layout = [("a", "a", 0), ("a", "a", 0), ("b", "卷一", 1), ("b", "卷一", 1), ("b", "卷二", 1), ("c", "c", 2)]
+    rng = np.random.default_rng(0)
+    for i, (name, chapter, axis) in enumerate(layout):
+        v = np.zeros(4)
+        v[axis] = 1.0
+        v += rng.normal(scale=0.05, size=4)
+        data.append({"id": str(i), "name": name, "chapter": chapter})
+        vecs.append(v / np.linalg.norm(v))
+    return data, np.array(vecs, dtype=np.float32)
+
+class TestHierarchicalIndex(unittest.TestCase):
+
+    def test_build_hierarchy(self):
+        data, emb = corpus()
+        h = build_hierarchy(data, emb)
+        self.assertEqual(h["entry_names"], ["a", "b", "c"])
+        self.assertEqual(h["chapter_names"], ["a", "卷一", "卷二", "c"])
+        np.testing.assert_array_equal(h["chapter_start"], [0, 2, 4, 5, 6])
+        np.testing.assert_array_almost_equal(np.linalg.norm(h["entry_centroids"], axis=1), np.ones(3))
+
+    def test_ranges_only_cover_top_entries(self):
+        data, emb = corpus()
+        h = build_hierarchy(data, emb)
+        q = np.array([0.0, 1.0, 0.0, 0.0])
+
+        ranges = hierarchical_ranges(h, q, top_entries=1)
+        self.assertEqual([(int(s), int(e)) for s, e in ranges], [(2, 5)])
+        ranges = hierarchical_ranges(h, q, top_entries=1, top_chapters=1)
+        self.assertEqual(len(ranges), 1)
+        self.assertLess(ranges[0][1] - ranges[0][0], 3)
+
+        indices, scores = score_ranges(emb, hierarchical_ranges(h, q, top_entries=3), q)
+        np.testing.assert_array_equal(indices, np.arange(6))
+        np.testing.assert_array_almost_equal(scores, emb @ q)
+
+    def test_benchmark_full_recall_with_all_entries(self):
+        data, emb = corpus()
+        h = build_hierarchy(data, emb)
+        rows = benchmark_hierarchy(emb, h, top_k=2, entry_options=(3,), chapter_options=(None,), n_queries=6)
+        self.assertEqual(rows[0]["mode"], "flat")
+        self.assertEqual(rows[1]["recall"], 1.0)
+
+    def test_benchmark_with_real_queries(self):
+        data, emb = corpus()
+        h = build_hierarchy(data, emb)
+        queries = emb[[0, 4]] + 0.01
+        queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+        rows = benchmark_hierarchy(emb, h, top_k=2, entry_options=(3,), chapter_options=(None,), queries=queries)
+        self.assertEqual(rows[1]["recall"], 1.0)
+
+if __name__ == '__main__':
+    unittest.main()
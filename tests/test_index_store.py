@@ -0,0 +1,54 @@
+import unittest
+import sys
+import os
+import tempfile
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from index_store import publish_index, resolve_current, IndexManager
+
+def payload(n):
+    data = [{"id": str(i), "name": "n", "category": "人物", "text": f"t{i}"} for i in range(n)]
+    return {'data': data, 'embeddings': np.eye(n, dtype=np.float32)}
+
+class TestIndexStore(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.vector_file = os.path.join(self.tmp.name, 'ming_vectors.pkl')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_publish_and_resolve(self):
+        self.assertIsNone(resolve_current(self.vector_file))
+        for n in range(1, 6):
+            version = publish_index(payload(n), self.vector_file, keep=2)
+        self.assertTrue(resolve_current(self.vector_file).endswith(f"ming_vectors-{version}.pkl"))
+        files = [f for f in os.listdir(os.path.join(self.tmp.name, 'index_versions')) if f.endswith('.pkl')]
+        self.assertEqual(len(files), 2)
+
+    def test_hot_swap_keeps_old_snapshot_until_released(self):
+        publish_index(payload(2), self.vector_file)
+        manager = IndexManager(self.vector_file)
+        self.assertFalse(manager.check_for_update())
+
+        in_flight = manager.acquire()
+        publish_index(payload(3), self.vector_file)
+        self.assertTrue(manager.check_for_update())
+
+        # New requests see the new version; the in-flight one still has the old data
+        fresh = manager.acquire()
+        self.assertEqual(len(fresh.data), 3)
+        self.assertEqual(len(in_flight.data), 2)
+        self.assertEqual(manager.status()['retired'], [in_flight.version])
+
+        manager.release(in_flight)
+        manager.release(fresh)
+        status = manager.status()
+        self.assertEqual(status['retired'], [])
+        self.assertEqual(status['refs'], {})
+
+if __name__ == '__main__':
+    unittest.main()
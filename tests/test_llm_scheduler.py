@@ -0,0 +1,90 @@
+import unittest
+import sys
+import os
+import threading
+import time
+from http import HTTPStatus
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from llm_scheduler import LLMScheduler, LLMResponse, QueueFullError
+
+class RecordingBackend:
+    requires_api_key = False
+
+    def __init__(self, latency=0.02, throttle_first=0, block_first=False):
+        self.latency = latency
+        self.throttle_first = throttle_first
+        # block_first: the first call sets `started`, then holds its worker until `release` is set
+        self.started = threading.Event()
+        self.release = threading.Event()
+        if not block_first:
+            self.release.set()
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.order = []
+
+    def call(self, prompt):
+        with self.lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.order.append(prompt)
+            throttled = self.throttle_first > 0
+            self.throttle_first -= 1
+        self.started.set()
+        self.release.wait()
+        time.sleep(self.latency)
+        with self.lock:
+            self.active -= 1
+        if throttled:
+            return LLMResponse(HTTPStatus.TOO_MANY_REQUESTS, None, 'Throttling', 'slow down')
+        return LLMResponse(HTTPStatus.OK, prompt, None, None)
+
+class TestLLMScheduler(unittest.TestCase):
+
+    def test_max_in_flight(self):
+        backend = RecordingBackend()
+        scheduler = LLMScheduler(backend, max_in_flight=2, max_queue=100)
+        futures = [scheduler.submit(f"p{i}") for i in range(10)]
+        self.assertEqual([f.result().text for f in futures], [f"p{i}" for i in range(10)])
+        scheduler.close()
+        self.assertLessEqual(backend.max_active, 2)
+        self.assertEqual(scheduler.metrics()['completed'], 10)
+
+    def test_sessions_are_served_round_robin(self):
+        backend = RecordingBackend(latency=0, block_first=True)
+        scheduler = LLMScheduler(backend, max_in_flight=1, max_queue=100)
+        # Occupy the only worker so everything below queues up
+        blocker = scheduler.submit("blocker", session_id="x")
+        backend.started.wait()
+        futures = [scheduler.submit(f"a{i}", session_id="a") for i in range(3)]
+        futures.append(scheduler.submit("b0", session_id="b"))
+        backend.release.set()
+        for f in futures + [blocker]: f.result()
+        scheduler.close()
+        self.assertEqual(backend.order, ["blocker", "a0", "b0", "a1", "a2"])
+
+    def test_throttled_calls_are_retried(self):
+        backend = RecordingBackend(latency=0, throttle_first=2)
+        scheduler = LLMScheduler(backend, max_in_flight=1, base_delay=0.001)
+        response = scheduler.submit("p").result()
+        scheduler.close()
+        self.assertEqual(response.status_code, HTTPStatus.OK)
+        self.assertEqual(scheduler.metrics()['retries'], 2)
+
+    def test_queue_full_sheds_load(self):
+        backend = RecordingBackend(latency=0, block_first=True)
+        scheduler = LLMScheduler(backend, max_in_flight=1, max_queue=2)
+        futures = [scheduler.submit("p0")]
+        backend.started.wait()
+        futures += [scheduler.submit("p1"), scheduler.submit("p2")]
+        with self.assertRaises(QueueFullError):
+            scheduler.submit("p3")
+        backend.release.set()
+        for f in futures: f.result()
+        scheduler.close()
+        self.assertEqual(scheduler.metrics()['rejected'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
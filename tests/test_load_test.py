@@ -0,0 +1,76 @@
+import unittest
+import sys
+import os
+import json
+import shutil
+import tempfile
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_test import percentile, summarize, window_mean, rss_bytes
+from encoders import HashingEncoderBackend
+from index_store import publish_index
+from chunk_table import ChunkTable
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TEXTS = ["张居正推行一条鞭法，内阁首辅总揽朝政。", "海瑞上疏批评嘉靖皇帝。", "戚继光在浙江抗击倭寇。",
+         "冯保掌司礼监，与张居正交好。", "于谦在北京保卫战中击退瓦剌。", "锦衣卫与东厂监察百官。"]
+
+class TestLoadTest(unittest.TestCase):
+
+    def test_percentile_interpolates(self):
+        values = [10, 20, 30, 40, 50]
+        self.assertEqual(percentile(values, 50), 30)
+        self.assertEqual(percentile(values, 90), 46)
+        self.assertEqual(percentile(values, 100), 50)
+        self.assertIsNone(percentile([], 50))
+
+    def test_summarize_by_kind(self):
+        requests = [
+            {"kind": "generate", "latency_ms": 100, "error": None},
+            {"kind": "generate", "latency_ms": 300, "error": "⏳ Queue full"},
+            {"kind": "page_load", "latency_ms": 50, "error": None},
+        ]
+        summary = summarize(requests)
+        self.assertEqual(summary["generate"]["count"], 2)
+        self.assertEqual(summary["generate"]["error_rate"], 0.5)
+        self.assertEqual(summary["generate"]["p50_ms"], 200)
+        self.assertEqual(summary["page_load"]["max_ms"], 50)
+
+    def test_window_mean_excludes_warmup(self):
+        # 2 items averaging 10ms during warm-up, then 2 more averaging 30ms
+        before = {"mean_wait_ms": 10.0, "items": 2}
+        after = {"mean_wait_ms": 20.0, "items": 4}
+        self.assertAlmostEqual(window_mean(before, after, "mean_wait_ms", "items"), 30.0)
+        self.assertIsNone(window_mean(after, after, "mean_wait_ms", "items"))
+
+    def test_rss_bytes(self):
+        self.assertGreater(rss_bytes(), 0)
+
+    def test_two_session_smoke_run(self):
+        # A separate process: other test modules replace streamlit with a MagicMock in sys.modules
+        with tempfile.TemporaryDirectory() as tmp:
+            app_file = os.path.join(tmp, 'app.py')
+            shutil.copy(os.path.join(REPO_DIR, 'app.py'), app_file)
+            records = [{"id": str(i), "name": f"人物{i}", "category": "人物", "text": t} for i, t in enumerate(TEXTS)]
+            publish_index({'columns': ChunkTable.from_records(records).to_columns(),
+                           'embeddings': HashingEncoderBackend().encode(TEXTS)}, os.path.join(tmp, 'ming_vectors.pkl'))
+
+            report_file = os.path.join(tmp, 'report.json')
+            subprocess.run([sys.executable, os.path.join(REPO_DIR, 'load_test.py'), '--app', app_file,
+                            '--sessions', '2', '--ramp-s', '0', '--reruns', '1', '--think-ms', '0', '--timeout', '60',
+                            '--encoder-latency-ms', '0', '--llm-latency-ms', '0', '--llm-jitter-ms', '0',
+                            '--cbdb-latency-ms', '0', '--json', report_file],
+                           cwd=tmp, env={**os.environ, 'PYTHONPATH': REPO_DIR}, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, timeout=300)
+            with open(report_file, encoding='utf-8') as f:
+                report = json.load(f)
+
+        self.assertEqual(report["sessions"], 2)
+        self.assertEqual(len(report["requests"]), 6)
+        self.assertEqual([r for r in report["requests"] if r["error"]], [])
+        self.assertEqual(report["latency"]["generate"]["count"], 2)
+
+if __name__ == '__main__':
+    unittest.main()
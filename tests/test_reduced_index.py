@@ -0,0 +1,61 @@
+import unittest
+import sys
+import os
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from reduced_index import fit_projection, project_corpus, project_query, reduced_search, benchmark_reduced
+
+def corpus(n=300, dim=32, rank=8, seed=0):
+    # Normalized vectors that lie close to a rank-8 subspace
+    rng = np.random.default_rng(seed)
+    basis = rng.normal(size=(rank, dim))
+    emb = rng.normal(size=(n, rank)) @ basis + rng.normal(scale=1e-3, size=(n, dim)) + 0.5
+    return (emb / np.linalg.norm(emb, axis=1, keepdims=True)).astype(np.float32)
+
+class TestReducedIndex(unittest.TestCase):
+
+    def test_projection_shapes(self):
+        emb = corpus()
+        projection = fit_projection(emb, dim=8)
+        reduced = project_corpus(projection, emb)
+        self.assertEqual(reduced.shape, (300, 8))
+        self.assertEqual(project_query(projection, emb[0]).shape, (8,))
+        self.assertGreater(projection["explained_variance"], 0.99)
+        # Asking for more dimensions than the vectors have is capped
+        self.assertEqual(fit_projection(emb, dim=64)["components"].shape, (32, 32))
+
+    def test_full_rank_pca_scores_differ_by_a_constant(self):
+        # With every component kept, reduced scores are q.x - q.mean: same ranking as the full scan
+        emb = corpus()
+        projection = fit_projection(emb, dim=32)
+        reduced = project_corpus(projection, emb)
+        q = emb[5]
+        np.testing.assert_allclose(reduced @ project_query(projection, q), emb @ q - q @ projection["mean"], atol=1e-5)
+
+    def test_reduced_search_rescores_with_full_vectors(self):
+        emb = corpus()
+        projection = fit_projection(emb, dim=4, whiten=True)
+        reduced = project_corpus(projection, emb)
+        q = emb[7]
+        indices, scores = reduced_search(projection, reduced, emb, q, top_k=5, candidates=len(emb))
+        np.testing.assert_array_equal(indices, np.argsort(-(emb @ q))[:5])
+        np.testing.assert_array_almost_equal(scores, emb[indices] @ q)
+
+    def test_benchmark_rows(self):
+        emb = corpus()
+        rows = benchmark_reduced(emb, top_k=5, dim_options=(8, 64), whiten_options=(False,),
+                                 candidate_options=(50,), n_queries=20)
+        self.assertEqual([r["mode"] for r in rows], ["flat", "reduced"])
+        self.assertGreaterEqual(rows[1]["recall"], 0.95)
+
+    def test_benchmark_with_real_queries(self):
+        # Queries from another distribution than the corpus; re-scoring every chunk is exact
+        emb, queries = corpus(), corpus(n=4, seed=1)
+        rows = benchmark_reduced(emb, top_k=5, dim_options=(8,), whiten_options=(False,),
+                                 candidate_options=(len(emb),), queries=queries)
+        self.assertEqual(rows[1]["recall"], 1.0)
+
+if __name__ == '__main__':
+    unittest.main()